@@ -0,0 +1,66 @@
+"""Compares two results of run.py, scenario by scenario.
+
+    python benchmarks/compare.py before.json after.json
+"""
+
+import json
+import sys
+
+
+METRICS = (
+    'seconds',
+    'records_per_second',
+    'queries',
+    'query_ms',
+    'peak_memory_kb',
+)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def change(before, after):
+    if not before or after is None:
+        return ''
+    return '%+.1f%%' % ((after - before) * 100.0 / before)
+
+
+def latency_metrics(report):
+    """Returns the p90 latency of each timing of the report."""
+    return dict(
+        ('%s p90_ms' % name, timing['p90_ms'])
+        for name, timing in report.get('latency', {}).items()
+    )
+
+
+def main(args):
+    if len(args) != 2:
+        sys.exit('usage: compare.py BEFORE AFTER')
+    before, after = load(args[0]), load(args[1])
+
+    if before.get('options') != after.get('options'):
+        sys.stdout.write('The runs used different options:\n%s\n%s\n\n' % (
+            before.get('options'), after.get('options')))
+
+    for name, after_report in sorted(after['scenarios'].items()):
+        before_report = before['scenarios'].get(name)
+        if before_report is None:
+            continue
+
+        sys.stdout.write('%s\n' % name)
+        before_metrics = dict(before_report, **latency_metrics(before_report))
+        after_metrics = dict(after_report, **latency_metrics(after_report))
+        metrics = list(METRICS) + sorted(latency_metrics(after_report))
+        for metric in metrics:
+            old, new = before_metrics.get(metric), after_metrics.get(metric)
+            sys.stdout.write('  %-20s %14s %14s %10s\n' % (
+                metric,
+                '-' if old is None else '%.1f' % old,
+                '-' if new is None else '%.1f' % new,
+                change(old, new)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,221 @@
+"""Generates the records of a PES as dumps, served by server.py.
+
+The records have the shapes the importers read. Their uuids are the same
+from one run to the next, so the objects of a previous run can be found.
+"""
+
+import datetime
+import random
+import uuid
+
+from coop_gateway.dump import write_dump
+
+
+NAMESPACE = uuid.UUID('6f1c1f36-5a57-4c0e-9b5c-1d1f4c1c0b3e')
+
+MEMBERS = 3
+CONTACTS = 2
+OCCURRENCES = 3
+
+
+def fixture_uuid(kind, number):
+    return str(uuid.uuid5(NAMESPACE, '%s-%s' % (kind, number)))
+
+
+def fixture_uuids(kind, count):
+    return [fixture_uuid(kind, number) for number in range(count)]
+
+
+def counts(size):
+    """Returns the number of records of each endpoint for size
+    organizations."""
+    return {
+        'locations': size,
+        'roles': 10,
+        'persons': size * 2,
+        'organizations': size,
+        'calendars': max(size // 100, 1),
+        'events': size,
+        'products': size,
+        'exchanges': size,
+    }
+
+
+def contacts(kind, number, media):
+    return [
+        {
+            'uuid': fixture_uuid('%s-contact' % kind, '%s-%s' % (number, i)),
+            'contact_medium': media[i % len(media)],
+            'content': '%s-%s-%s@example.org' % (kind, number, i),
+        }
+        for i in range(CONTACTS)
+    ]
+
+
+def locations(count, rand):
+    for number in range(count):
+        yield {
+            'uuid': fixture_uuid('location', number),
+            'label': 'Location %s' % number,
+            'adr1': '%s rue de la Paix' % rand.randint(1, 200),
+            'adr2': '',
+            'zipcode': '%05d' % rand.randint(1000, 99999),
+            'city': 'Paris',
+            'country': 'FR',
+        }
+
+
+def roles(count):
+    for number in range(count):
+        yield {
+            'uuid': fixture_uuid('role', number),
+            'label': 'Role %s' % number,
+            'slug': 'role-%s' % number,
+        }
+
+
+def legal_statuses(labels):
+    for number, label in enumerate(labels):
+        yield {
+            'uuid': fixture_uuid('legal_status', number),
+            'label': label,
+            'slug': 'legal-status-%s' % number,
+        }
+
+
+def persons(count, media):
+    for number in range(count):
+        person_contacts = contacts('person', number, media)
+        yield {
+            'uuid': fixture_uuid('person', number),
+            'first_name': 'First %s' % number,
+            'last_name': 'Last %s' % number,
+            'contacts': person_contacts,
+            'pref_email': person_contacts[0]['uuid'],
+        }
+
+
+def organizations(count, sizes, media, statuses, rand):
+    for number in range(count):
+        organization_contacts = contacts('organization', number, media)
+        yield {
+            'uuid': fixture_uuid('organization', number),
+            'title': 'Organization %s' % number,
+            'description': 'Description of organization %s' % number,
+            'acronym': 'O%s' % number,
+            'testimony': '',
+            'annual_revenue': rand.randint(0, 1000000),
+            'workforce': rand.randint(1, 500),
+            'birth': '2001-02-03',
+            'web': 'http://example.org/%s' % number,
+            'legal_status': 'legal-status-%s' % rand.randrange(statuses),
+            'contacts': organization_contacts,
+            'pref_email': organization_contacts[0]['uuid'],
+            'pref_phone': organization_contacts[-1]['uuid'],
+            'members': [
+                {
+                    'person': fixture_uuid('person',
+                                           rand.randrange(sizes['persons'])),
+                    'role': fixture_uuid('role',
+                                         rand.randrange(sizes['roles'])),
+                    'role_detail': '',
+                }
+                for _ in range(MEMBERS)
+            ],
+        }
+
+
+def calendars(count):
+    for number in range(count):
+        yield {
+            'uuid': fixture_uuid('calendar', number),
+            'title': 'Calendar %s' % number,
+            'description': '',
+        }
+
+
+def events(count, sizes, rand):
+    start = datetime.datetime(2020, 1, 1, 9)
+    for number in range(count):
+        yield {
+            'uuid': fixture_uuid('event', number),
+            'title': 'Event %s' % number,
+            'description': 'Description of event %s' % number,
+            'other_organizations': '',
+            'source_info': '',
+            'calendar': fixture_uuid('calendar',
+                                     rand.randrange(sizes['calendars'])),
+            'organization': fixture_uuid(
+                'organization', rand.randrange(sizes['organizations'])),
+            'organizations': [
+                fixture_uuid('organization',
+                             rand.randrange(sizes['organizations']))
+                for _ in range(2)
+            ],
+            'occurrences': [
+                {
+                    'start_time': (start + datetime.timedelta(
+                        days=number + i)).isoformat(),
+                    'end_time': (start + datetime.timedelta(
+                        days=number + i, hours=2)).isoformat(),
+                }
+                for i in range(OCCURRENCES)
+            ],
+        }
+
+
+def products(count, sizes, rand):
+    for number in range(count):
+        yield {
+            'uuid': fixture_uuid('product', number),
+            'title': 'Product %s' % number,
+            'description': '',
+            'organization': fixture_uuid(
+                'organization', rand.randrange(sizes['organizations'])),
+        }
+
+
+def exchanges(count, sizes, eways, etypes, rand):
+    for number in range(count):
+        yield {
+            'uuid': fixture_uuid('exchange', number),
+            'title': 'Exchange %s' % number,
+            'permanent': bool(number % 2),
+            'expiration': '2030-01-01',
+            'description': '',
+            'person': fixture_uuid('person',
+                                   rand.randrange(sizes['persons'])),
+            'products': [
+                fixture_uuid('product', rand.randrange(sizes['products']))
+            ],
+            'methods': [],
+            'eway': eways[number % len(eways)],
+            'etype': etypes[number % len(etypes)],
+        }
+
+
+def generate(directory, size, contact_media, legal_status_labels, eways,
+             etypes, seed=0):
+    """Writes the dumps of a PES holding size organizations, returns the
+    number of records of each endpoint."""
+    rand = random.Random(seed)
+    sizes = counts(size)
+    statuses = len(legal_status_labels)
+
+    listings = [
+        ('locations', locations(sizes['locations'], rand)),
+        ('roles', roles(sizes['roles'])),
+        ('legal_statuses', legal_statuses(legal_status_labels)),
+        ('persons', persons(sizes['persons'], contact_media)),
+        ('organizations', organizations(sizes['organizations'], sizes,
+                                        contact_media, statuses, rand)),
+        ('calendars', calendars(sizes['calendars'])),
+        ('events', events(sizes['events'], sizes, rand)),
+        ('products', products(sizes['products'], sizes, rand)),
+        ('exchanges', exchanges(sizes['exchanges'], sizes, eways, etypes,
+                                rand)),
+    ]
+    return dict(
+        (name, write_dump(directory, name, records))
+        for name, records in listings
+    )
@@ -0,0 +1,96 @@
+"""Measures taken while a scenario runs: latencies, SQL queries and peak
+memory."""
+
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def summarize(durations):
+    """Returns the count, total and percentiles of durations, in
+    milliseconds."""
+    return {
+        'count': len(durations),
+        'total_ms': sum(durations) * 1000,
+        'p50_ms': percentile(durations, 0.5) * 1000,
+        'p90_ms': percentile(durations, 0.9) * 1000,
+        'p99_ms': percentile(durations, 0.99) * 1000,
+        'max_ms': max(durations) * 1000,
+    }
+
+
+class Recorder(object):
+    """Collects durations by name, from any thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = {}
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.durations.setdefault(name, []).append(seconds)
+
+    @contextmanager
+    def timing(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def summary(self):
+        return dict(
+            (name, summarize(durations))
+            for name, durations in self.durations.items()
+        )
+
+
+def record_http(recorder):
+    """Records the duration of the requests sent to the PES, until their
+    response headers, by method."""
+    from coop_gateway import client
+
+    original = client.request
+
+    def request(method, url, **kwargs):
+        with recorder.timing('http %s' % method):
+            return original(method, url, **kwargs)
+
+    client.request = request
+
+
+def record_queries(recorder):
+    """Records the duration of the SQL queries of the default connection,
+    without keeping them like DEBUG does."""
+    from django.db import connection
+    from django.db.backends.util import CursorWrapper
+
+    class TimedCursor(CursorWrapper):
+
+        def execute(self, *args):
+            with recorder.timing('sql'):
+                return self.cursor.execute(*args)
+
+        def executemany(self, *args):
+            with recorder.timing('sql'):
+                return self.cursor.executemany(*args)
+
+    connection.use_debug_cursor = True
+    connection.make_debug_cursor = lambda cursor: TimedCursor(cursor,
+                                                              connection)
+
+
+def peak_memory_kb():
+    """Returns the peak resident memory of the process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes instead of kilobytes
+        peak //= 1024
+    return peak
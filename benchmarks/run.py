@@ -0,0 +1,292 @@
+"""Runs the benchmarks of coop_gateway against a local stand-in of the PES.
+
+Run it from a Django project using coop_gateway, on a scratch database with
+at least one contact medium::
+
+    DJANGO_SETTINGS_MODULE=project.settings python benchmarks/run.py \\
+        --size 1000 --output results.json
+
+The records of a PES are generated, served by server.py, then each scenario
+runs in its own process and reports its throughput, latency percentiles,
+SQL queries and peak memory. The results are written as JSON, compare two
+of them with compare.py.
+"""
+
+import datetime
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import (
+    SUPPRESS_HELP,
+    OptionParser,
+)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# The coop_gateway of this checkout is the one measured
+sys.path.insert(0, os.path.dirname(HERE))
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+
+def setup_django():
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+
+def parse_options(args):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--size', type='int', dest='size', default=1000,
+                      help='Number of organizations of the PES, the other '
+                           'records are proportional')
+    parser.add_option('--output', dest='output', default='benchmark.json',
+                      help='File the results are written to')
+    parser.add_option('--scenario', action='append', dest='scenarios',
+                      default=None,
+                      help='Scenario to run, every one by default, can be '
+                           'repeated')
+    parser.add_option('--engine', dest='engine', default='record',
+                      help='Engine of pes_import')
+    parser.add_option('--chunk-size', type='int', dest='chunk_size',
+                      default=100,
+                      help='Number of records imported per transaction')
+    parser.add_option('--batch-size', type='int', dest='batch_size',
+                      default=None,
+                      help='Size of the bulk requests of pes_export')
+    parser.add_option('--workers', type='int', dest='workers', default=1,
+                      help='Number of requests sent concurrently by '
+                           'pes_export')
+    parser.add_option('--latency', type='float', dest='latency', default=0,
+                      help='Milliseconds the stand-in waits before each '
+                           'answer')
+    parser.add_option('--no-bulk', action='store_false', dest='bulk',
+                      default=True,
+                      help='The stand-in has no bulk endpoints')
+    parser.add_option('--child', dest='child', default=None,
+                      help=SUPPRESS_HELP)
+    parser.add_option('--pes-host', dest='pes_host', default=None,
+                      help=SUPPRESS_HELP)
+    parser.add_option('--result', dest='result', default=None,
+                      help=SUPPRESS_HELP)
+    return parser.parse_args(args)[0]
+
+
+def project_choices():
+    """Returns the values of the project the fixtures must use."""
+    from coop.exchange.models import (
+        ETYPE,
+        EWAY,
+    )
+    from coop_local.models import Contact
+    from coop_local.models.local_models import STATUTS
+
+    medium_model = Contact._meta.get_field('contact_medium').rel.to
+    media = list(medium_model.objects.values_list('pk', flat=True))
+    if not media:
+        sys.exit('Create a contact medium first')
+
+    return {
+        'contact_media': media,
+        'legal_status_labels': list(STATUTS.CHOICES_DICT.values()),
+        'eways': list(EWAY.CHOICES_CONST_DICT.keys()),
+        'etypes': list(ETYPE.CHOICES_CONST_DICT.keys()),
+    }
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(directory, options):
+    port = free_port()
+    command = [sys.executable, os.path.join(HERE, 'server.py'),
+               '--port', str(port), '--latency', str(options.latency)]
+    if not options.bulk:
+        command.append('--no-bulk')
+    server = subprocess.Popen(command + [directory])
+
+    host = 'http://127.0.0.1:%s/' % port
+    deadline = time.time() + 30
+    while True:
+        try:
+            urlopen(host + 'stats/').read()
+            return server, host
+        except IOError:
+            if time.time() > deadline or server.poll() is not None:
+                server.terminate()
+                sys.exit('The PES stand-in did not start')
+            time.sleep(0.1)
+
+
+def server_stats(host):
+    return json.loads(urlopen(host + 'stats/').read().decode('utf-8'))
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=HERE,
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_child(name, host, options):
+    """Runs a scenario in its own process, so its peak memory is its own."""
+    handle, result = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    command = [sys.executable, os.path.abspath(__file__),
+               '--child', name, '--pes-host', host, '--result', result,
+               '--size', str(options.size), '--engine', options.engine,
+               '--chunk-size', str(options.chunk_size),
+               '--workers', str(options.workers)]
+    if options.batch_size:
+        command.extend(['--batch-size', str(options.batch_size)])
+
+    try:
+        before = server_stats(host)
+        subprocess.check_call(command)
+        after = server_stats(host)
+        with open(result) as f:
+            report = json.load(f)
+    finally:
+        os.remove(result)
+
+    report['server'] = {
+        'requests': dict(
+            (method, count - before['requests'].get(method, 0))
+            for method, count in after['requests'].items()
+        ),
+        'bytes_received': after['bytes_received'] - before['bytes_received'],
+        'bytes_sent': after['bytes_sent'] - before['bytes_sent'],
+    }
+    return report
+
+
+def child(options):
+    """Runs the scenario options.child and writes its report."""
+    setup_django()
+
+    from django.conf import settings
+    from django.core.cache import cache
+
+    from coop_gateway import reference
+
+    from measure import (
+        Recorder,
+        peak_memory_kb,
+        record_http,
+        record_queries,
+    )
+    from scenarios import SCENARIOS
+
+    settings.PES_HOST = options.pes_host
+    settings.PES_API_KEY = 'benchmark'
+    # The reference data of another PES may be cached
+    for data in (reference.roles, reference.legal_statuses):
+        cache.delete(data.key)
+
+    scenario = SCENARIOS[options.child](vars(options))
+    scenario.setup()
+
+    recorder = Recorder()
+    record_http(recorder)
+    record_queries(recorder)
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    try:
+        records = scenario.run(recorder)
+    finally:
+        seconds = time.time() - start
+        sys.stdout.close()
+        sys.stdout = stdout
+        scenario.teardown()
+
+    latencies = recorder.summary()
+    queries = latencies.pop('sql', {'count': 0, 'total_ms': 0})
+    report = {
+        'records': records,
+        'seconds': seconds,
+        'records_per_second': records / seconds if seconds else None,
+        'latency': latencies,
+        'queries': queries['count'],
+        'query_ms': queries['total_ms'],
+        'peak_memory_kb': peak_memory_kb(),
+    }
+    with open(options.result, 'w') as f:
+        json.dump(report, f)
+
+
+def main(args):
+    options = parse_options(args)
+    if options.child:
+        return child(options)
+
+    setup_django()
+    from fixtures import generate
+    from scenarios import SCENARIOS
+
+    names = options.scenarios or list(SCENARIOS.keys())
+    for name in names:
+        if name not in SCENARIOS:
+            sys.exit('Unknown scenario %s' % name)
+
+    directory = tempfile.mkdtemp(prefix='coop-gateway-benchmark-')
+    try:
+        sys.stdout.write('Generating the records of %s organizations\n' %
+                         options.size)
+        records = generate(directory, options.size, **project_choices())
+
+        server, host = start_server(directory, options)
+        try:
+            scenarios = {}
+            for name in names:
+                sys.stdout.write('Running %s\n' % name)
+                scenarios[name] = run_child(name, host, options)
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        shutil.rmtree(directory)
+
+    results = {
+        'date': datetime.datetime.now().isoformat(),
+        'commit': commit(),
+        'python': sys.version.split()[0],
+        'options': dict(
+            (name, getattr(options, name))
+            for name in ('size', 'engine', 'chunk_size', 'batch_size',
+                         'workers', 'latency', 'bulk')
+        ),
+        'records': records,
+        'scenarios': scenarios,
+    }
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    for name in names:
+        report = scenarios[name]
+        sys.stdout.write(
+            '%-10s %8d records %8.2f s %10.1f records/s %8d queries '
+            '%8d KB\n' % (name, report['records'], report['seconds'],
+                          report['records_per_second'] or 0,
+                          report['queries'], report['peak_memory_kb']))
+    sys.stdout.write('Results written to %s\n' % options.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
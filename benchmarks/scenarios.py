@@ -0,0 +1,152 @@
+"""The scenarios run by run.py, each one in its own process.
+
+A scenario prepares the database in ``setup``, which is not measured, and
+returns the number of records it handled from ``run``.
+"""
+
+import time
+from collections import OrderedDict
+
+from django.core.management import call_command
+
+from coop_gateway.dump import endpoint_name
+from coop_gateway.management.commands.pes_export import (
+    Command as PesExportCommand,
+)
+from coop_gateway.management.commands.pes_import import PesImportCommand
+from coop_gateway.models import (
+    ImportState,
+    OutboxEntry,
+)
+from coop_gateway.outbox import drain
+
+from fixtures import (
+    counts,
+    fixture_uuids,
+)
+
+
+def chunks(items, size=500):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def fixture_models(size):
+    """Yields the model, foreign model and fixture uuids of each endpoint,
+    in the order they are imported."""
+    sizes = counts(size)
+    for handler_class in PesImportCommand.handler_classes:
+        name = endpoint_name(handler_class.endpoint)
+        yield (handler_class.model, handler_class.foreign_model,
+               fixture_uuids(name[:-1], sizes[name]))
+
+
+def fixture_objects(model, uuids):
+    objects = []
+    for chunk in chunks(uuids):
+        objects.extend(model.objects.filter(uuid__in=chunk))
+    return objects
+
+
+class Scenario(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.size = options['size']
+
+    def setup(self):
+        pass
+
+    def run(self, recorder):
+        raise NotImplementedError
+
+    def teardown(self):
+        pass
+
+
+class Import(Scenario):
+    """pes_import --full into a database without the fixtures."""
+
+    def setup(self):
+        for model, _, uuids in reversed(list(fixture_models(self.size))):
+            for chunk in chunks(uuids):
+                model.objects.filter(uuid__in=chunk).delete()
+        ImportState.objects.all().delete()
+
+    def run(self, recorder):
+        call_command('pes_import', full=True,
+                     engine=self.options['engine'],
+                     chunk_size=self.options['chunk_size'])
+        return sum(counts(self.size).values())
+
+
+class Reimport(Import):
+    """pes_import --full of the same records, over the imported objects."""
+
+    def setup(self):
+        ImportState.objects.all().delete()
+
+
+class Export(Scenario):
+    """pes_export --full --force of the imported objects, made local for the
+    time of the run."""
+
+    def setup(self):
+        self.foreign = []
+        for model, foreign_model, uuids in fixture_models(self.size):
+            if model not in PesExportCommand.models:
+                continue
+            pks = [instance.pk for instance in fixture_objects(model, uuids)]
+            for chunk in chunks(pks):
+                foreign_model.objects.filter(local_object__in=chunk).delete()
+            self.foreign.append((foreign_model, pks))
+
+    def run(self, recorder):
+        call_command('pes_export', full=True, force=True,
+                     batch_size=self.options['batch_size'],
+                     workers=self.options['workers'])
+        return sum(len(pks) for _, pks in self.foreign)
+
+    def teardown(self):
+        for foreign_model, pks in self.foreign:
+            for chunk in chunks(pks):
+                foreign_model.objects.bulk_create([
+                    foreign_model(local_object_id=pk)
+                    for pk in chunk
+                ])
+
+
+class Signals(Scenario):
+    """Saves of organizations and persons queued by the signals, then sent
+    like pes_push does."""
+
+    # The field changed by each save, so the payload changes too
+    fields = {
+        'Organization': 'description',
+        'Person': 'first_name',
+    }
+
+    def setup(self):
+        self.instances = []
+        for model, _, uuids in fixture_models(self.size):
+            if model.__name__ in self.fields:
+                self.instances.extend(fixture_objects(model, uuids))
+        OutboxEntry.objects.all().delete()
+
+    def run(self, recorder):
+        stamp = 'Saved at %s' % time.time()
+        for instance in self.instances:
+            setattr(instance, self.fields[type(instance).__name__], stamp)
+            with recorder.timing('save'):
+                instance.save()
+
+        with recorder.timing('drain'):
+            drain()
+        return len(self.instances)
+
+
+SCENARIOS = OrderedDict([
+    ('import', Import),
+    ('reimport', Reimport),
+    ('export', Export),
+    ('signals', Signals),
+])
@@ -0,0 +1,194 @@
+"""A stand-in for the PES API, serving the dumps of a directory.
+
+    python benchmarks/server.py --port 8000 DIRECTORY
+
+GET /api/<name>/ answers the records of the dump <name>.ndjson.gz as a JSON
+array, or by pages with their count and next page when page_size is given.
+PUT and DELETE /api/<name>/<uuid>/ and /api/<name>/bulk/ are accepted, the
+bulk endpoints answer 404 with --no-bulk. GET /stats/ answers the number of
+requests and bytes received and sent.
+"""
+
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+try:
+    from http.server import (
+        BaseHTTPRequestHandler,
+        HTTPServer,
+    )
+    from socketserver import ThreadingMixIn
+    from urllib.parse import (
+        parse_qs,
+        urlparse,
+    )
+except ImportError:
+    from BaseHTTPServer import (
+        BaseHTTPRequestHandler,
+        HTTPServer,
+    )
+    from SocketServer import ThreadingMixIn
+    from urlparse import (
+        parse_qs,
+        urlparse,
+    )
+
+
+SUFFIX = '.ndjson.gz'
+
+
+def load_listings(directory):
+    """Returns the encoded records of the dumps of directory by name."""
+    listings = {}
+    for filename in os.listdir(directory):
+        if filename.endswith(SUFFIX):
+            with gzip.open(os.path.join(directory, filename), 'rb') as f:
+                listings[filename[:-len(SUFFIX)]] = [
+                    line.strip()
+                    for line in f
+                    if line.strip()
+                ]
+    return listings
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, listings, bulk=True, latency=0):
+        HTTPServer.__init__(self, address, Handler)
+        self.listings = listings
+        self.bulk = bulk
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.stats = {'requests': {}, 'bytes_received': 0, 'bytes_sent': 0}
+
+    def count(self, method, received, sent):
+        with self.lock:
+            requests = self.stats['requests']
+            requests[method] = requests.get(method, 0) + 1
+            self.stats['bytes_received'] += received
+            self.stats['bytes_sent'] += sent
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def route(self):
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        query = dict(
+            (name, values[-1])
+            for name, values in parse_qs(url.query).items()
+        )
+        return parts, query
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def respond(self, status, body, received=0):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(self.command, received, len(body))
+
+    def respond_json(self, status, data, received=0):
+        self.respond(status, json.dumps(data).encode('utf-8'), received)
+
+    def page(self, name, records, query):
+        page_size = max(int(query['page_size']), 1)
+        number = int(query.get('page', 1))
+        start = (number - 1) * page_size
+        next_url = None
+        if start + page_size < len(records):
+            next_url = 'http://%s/api/%s/?page=%s&page_size=%s' % (
+                self.headers.get('Host'), name, number + 1, page_size)
+        head = json.dumps({'count': len(records), 'next': next_url})
+        return b''.join([
+            head[:-1].encode('utf-8'),
+            b', "results": [',
+            b', '.join(records[start:start + page_size]),
+            b']}',
+        ])
+
+    def do_GET(self):
+        parts, query = self.route()
+        if parts == ['stats']:
+            with self.server.lock:
+                body = json.dumps(self.server.stats).encode('utf-8')
+            return self.respond(200, body)
+
+        if len(parts) != 2 or parts[0] != 'api' \
+                or parts[1] not in self.server.listings:
+            return self.respond_json(404, {'detail': 'Not found'})
+
+        records = self.server.listings[parts[1]]
+        if 'page_size' in query:
+            return self.respond(200, self.page(parts[1], records, query))
+        self.respond(200, b'[' + b', '.join(records) + b']')
+
+    def write(self, action):
+        body = self.read_body()
+        parts, _ = self.route()
+        if len(parts) != 3 or parts[0] != 'api':
+            return self.respond_json(404, {'detail': 'Not found'},
+                                     len(body))
+
+        if parts[2] != 'bulk':
+            return self.respond_json(200, {}, len(body))
+        if not self.server.bulk:
+            return self.respond_json(404, {'detail': 'Not found'},
+                                     len(body))
+
+        items = json.loads(body.decode('utf-8'))
+        self.respond_json(200, [
+            {'uuid': item['uuid'] if action == 'push' else item,
+             'status': 200}
+            for item in items
+        ], len(body))
+
+    def do_PUT(self):
+        self.write('push')
+
+    def do_DELETE(self):
+        self.write('delete')
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] DIRECTORY')
+    parser.add_option('--host', dest='host', default='127.0.0.1')
+    parser.add_option('--port', type='int', dest='port', default=8000)
+    parser.add_option('--no-bulk', action='store_false', dest='bulk',
+                      default=True,
+                      help='Answer 404 to the bulk endpoints')
+    parser.add_option('--latency', type='float', dest='latency', default=0,
+                      help='Milliseconds waited before each answer')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('A directory of dumps is required')
+
+    server = Server((options.host, options.port), load_listings(args[0]),
+                    options.bulk, options.latency / 1000.0)
+    sys.stdout.write('Serving %s on http://%s:%s/\n' % (
+        args[0], options.host, options.port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,9 @@ from coop_local.models import (
     Organization,
     Person,
     Product,
+    Role,
 )
+from .serializers import local_roles_changed
 from .signals import (
     calendar_deleted,
     calendar_saved,
@@ -49,3 +51,6 @@ post_delete.connect(product_deleted, Product)
 
 post_save.connect(exchange_saved, Exchange)
 post_delete.connect(exchange_deleted, Exchange)
+
+post_save.connect(local_roles_changed, Role)
+post_delete.connect(local_roles_changed, Role)
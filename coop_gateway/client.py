@@ -0,0 +1,85 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+from coop_gateway import report
+
+
+_local = threading.local()
+
+
+def setting(name, default):
+    return getattr(settings, name, default)
+
+
+def get_session():
+    """Returns the session of the current thread, keeping its connections
+    to the PES alive between requests."""
+    session = getattr(_local, 'session', None)
+    if session is None:
+        pool_size = setting('PES_POOL_SIZE', 10)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _local.session = session
+    return session
+
+
+def is_retryable(response):
+    # Not Implemented will not change by asking again
+    return response.status_code >= 500 and response.status_code != 501
+
+
+def send(method, url, **kwargs):
+    """Sends a request to the PES, retrying connection errors and server
+    errors with an exponential backoff."""
+    kwargs.setdefault('timeout', (setting('PES_CONNECT_TIMEOUT', 5),
+                                  setting('PES_READ_TIMEOUT', 30)))
+    retries = setting('PES_RETRIES', 3)
+    backoff = setting('PES_BACKOFF', 0.5)
+
+    attempt = 0
+    while True:
+        try:
+            response = get_session().request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt >= retries:
+                raise
+        else:
+            if attempt >= retries or not is_retryable(response):
+                return response
+            response.close()
+
+        time.sleep(backoff * (2 ** attempt))
+        attempt += 1
+
+
+def request(method, url, **kwargs):
+    """Sends a request to the PES, counting it in the report of the run.
+
+    The body of a streamed response is counted while it is read.
+    """
+    start = time.time()
+    response = send(method, url, **kwargs)
+    received = 0 if kwargs.get('stream') else len(response.content)
+    report.request(method, url, time.time() - start,
+                   len(kwargs.get('data') or ''), received)
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
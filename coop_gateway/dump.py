@@ -0,0 +1,76 @@
+import gzip
+import json
+import mmap
+import os
+
+from coop_gateway import report
+
+
+SUFFIX = '.ndjson.gz'
+
+
+def endpoint_name(endpoint):
+    """Returns the name of the dump of an endpoint like api/organizations/."""
+    return endpoint.strip('/').split('/')[-1]
+
+
+def dump_path(directory, name):
+    return os.path.join(directory, name + SUFFIX)
+
+
+def write_dump(directory, name, records):
+    """Writes the records to the dump of name, one JSON object per line,
+    returns the number of records written.
+
+    The dump is replaced once complete, a failed dump leaves the previous
+    one untouched.
+    """
+    path = dump_path(directory, name)
+    temporary_path = path + '.tmp'
+    count = 0
+    with gzip.open(temporary_path, 'wb') as f:
+        for data in records:
+            f.write(json.dumps(data).encode('utf-8') + b'\n')
+            count += 1
+    os.rename(temporary_path, path)
+    return count
+
+
+def read_dump(path):
+    """Yields the records of a dump.
+
+    The file is memory-mapped and decompressed while iterating, so only the
+    current record is kept in memory whatever the size of the dump.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for line in gzip.GzipFile(fileobj=mapped, mode='rb'):
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+        finally:
+            mapped.close()
+
+
+class DumpListing(object):
+    """The records of a dump, read like a listing of the PES.
+
+    A missing dump is read like a listing that did not change.
+    """
+
+    def __init__(self, directory, name):
+        self.path = dump_path(directory, name)
+        self.response_headers = {}
+        self.not_modified = False
+
+    def __iter__(self):
+        if not os.path.exists(self.path):
+            report.log('No dump %s' % self.path, 1)
+            self.not_modified = True
+            return
+
+        report.log('READ %s' % self.path)
+        for data in read_dump(self.path):
+            yield data
@@ -0,0 +1,47 @@
+class IdentityMap(object):
+    """Objects looked up by uuid during an import, by (model, uuid).
+
+    References are resolved from the map, and the references of a chunk of
+    records can be loaded beforehand with one query per model. Objects not
+    found are not remembered, they may be created later in the import.
+    """
+
+    def __init__(self):
+        self.objects = {}
+
+    def forget(self, model, pks):
+        """Forgets the objects of model with the pks, once deleted."""
+        pks = set(pks)
+        for key, instance in list(self.objects.items()):
+            if key[0] is model and instance.pk in pks:
+                del self.objects[key]
+
+    def preload(self, model, uuids):
+        missing = list(set(
+            uuid
+            for uuid in uuids
+            if uuid and (model, uuid) not in self.objects
+        ))
+        for i in range(0, len(missing), 500):
+            for instance in model.objects.filter(uuid__in=missing[i:i + 500]):
+                self.objects[(model, instance.uuid)] = instance
+
+    def get(self, model, uuid):
+        """Returns the object of model with the uuid, or None."""
+        if not uuid:
+            return None
+        key = (model, uuid)
+        if key not in self.objects:
+            try:
+                self.objects[key] = model.objects.get(uuid=uuid)
+            except model.DoesNotExist:
+                return None
+        return self.objects[key]
+
+    def get_many(self, model, uuids):
+        self.preload(model, uuids)
+        return [
+            self.objects[(model, uuid)]
+            for uuid in uuids
+            if (model, uuid) in self.objects
+        ]
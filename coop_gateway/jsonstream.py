@@ -0,0 +1,69 @@
+import codecs
+import json
+import re
+
+
+_whitespace = re.compile(r'\s*')
+
+
+class JSONStreamError(ValueError):
+    pass
+
+
+def iter_array(chunks, encoding='utf-8'):
+    """Yields the items of the JSON array sent in chunks of bytes, as soon
+    as each one is complete.
+
+    Only the item being parsed is kept in memory, not the whole array.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    buffer = ''
+    started = False
+    chunks = iter(chunks)
+    eof = False
+
+    while True:
+        pos = _whitespace.match(buffer, 0).end()
+
+        while pos < len(buffer):
+            char = buffer[pos]
+            if not started:
+                if char != '[':
+                    raise JSONStreamError('Expected a JSON array')
+                started = True
+                pos += 1
+            elif char == ']':
+                return
+            elif char == ',':
+                pos += 1
+            else:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                    # The item continues in the next chunk
+                    break
+                if not isinstance(item, (dict, list)):
+                    after = _whitespace.match(buffer, end).end()
+                    if after == len(buffer) or buffer[after] not in ',]':
+                        if eof:
+                            raise JSONStreamError('Invalid JSON array item')
+                        # A number may continue in the next chunk
+                        break
+                yield item
+                pos = end
+            pos = _whitespace.match(buffer, pos).end()
+
+        buffer = buffer[pos:]
+        if eof:
+            raise JSONStreamError('Unexpected end of the JSON array')
+
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            eof = True
+            buffer += text_decoder.decode(b'', final=True)
+        else:
+            buffer += text_decoder.decode(chunk)
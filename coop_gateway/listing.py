@@ -0,0 +1,299 @@
+import json
+import math
+import tempfile
+import threading
+import time
+from collections import deque
+from itertools import (
+    chain,
+    islice,
+)
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib.parse import (
+        parse_qsl,
+        urlsplit,
+        urlunsplit,
+    )
+except ImportError:
+    from urlparse import (
+        parse_qsl,
+        urlsplit,
+        urlunsplit,
+    )
+
+from django.conf import settings
+
+from coop_gateway import (
+    client,
+    report,
+)
+from coop_gateway.jsonstream import iter_array
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def default_page_size():
+    return getattr(settings, 'PES_PAGE_SIZE', None)
+
+
+def default_prefetch():
+    return getattr(settings, 'PES_PREFETCH_PAGES', 2)
+
+
+def fetch_page(url, params=None):
+    report.log('GET %s %s' % (url, params or ''))
+    response = client.get(url, params=params)
+    response.raise_for_status()
+    return response.json()
+
+
+def iter_numbered_pages(url, queries, prefetch):
+    """Yields the pages of url with the given queries, downloading up to
+    prefetch of them ahead."""
+    pool = ThreadPool(prefetch)
+    try:
+        queries = iter(queries)
+        pending = deque(
+            pool.apply_async(fetch_page, (url, query))
+            for query in islice(queries, prefetch)
+        )
+        while pending:
+            page = pending.popleft().get()
+            for query in islice(queries, 1):
+                pending.append(pool.apply_async(fetch_page, (url, query)))
+            yield page
+    finally:
+        pool.terminate()
+
+
+def iter_linked_pages(page):
+    """Yields the pages following page by their next links, downloading
+    each one while the previous one is used."""
+    pool = ThreadPool(1)
+    try:
+        pending = None
+        if page.get('next'):
+            pending = pool.apply_async(fetch_page, (page['next'],))
+        while pending is not None:
+            page = pending.get()
+            pending = None
+            if page.get('next'):
+                pending = pool.apply_async(fetch_page, (page['next'],))
+            yield page
+    finally:
+        pool.terminate()
+
+
+def next_queries(first_page):
+    """Returns the url and the queries of the pages following first_page,
+    or None when they can not be told from its next link.
+
+    The queries are built from the one of the next link, by page number or
+    by offset depending on what it carries.
+    """
+    results = first_page['results']
+    if 'count' not in first_page or not results or not first_page.get('next'):
+        return None
+
+    parts = urlsplit(first_page['next'])
+    url = urlunsplit(parts[:3] + ('', ''))
+    query = dict(parse_qsl(parts.query))
+    count = first_page['count']
+
+    if 'page' in query:
+        pages = int(math.ceil(count / float(len(results))))
+        return url, [
+            dict(query, page=number)
+            for number in range(int(query['page']), pages + 1)
+        ]
+    if 'offset' in query and 'limit' in query:
+        return url, [
+            dict(query, offset=offset)
+            for offset in range(int(query['offset']), count,
+                                int(query['limit']))
+        ]
+    return None
+
+
+def iter_pages(first_page, prefetch):
+    yield first_page
+
+    numbered = next_queries(first_page)
+    if numbered is not None:
+        url, queries = numbered
+        pages = iter_numbered_pages(url, queries, prefetch)
+    else:
+        pages = iter_linked_pages(first_page)
+    for page in pages:
+        yield page
+
+
+class Listing(object):
+    """The records of a PES listing, read while iterating over it.
+
+    A listing sent as a JSON array is parsed while it is downloaded. A
+    paginated listing, a JSON object with the records in ``results`` and
+    the url of the next page in ``next``, is read page by page, the next
+    pages being downloaded while the current one is used. When it gives
+    the ``count`` of records and its next link a ``page`` number or an
+    ``offset`` and ``limit``, up to prefetch pages are downloaded at once.
+
+    Once iterated, ``response_headers`` holds the headers of the first
+    response, ``elapsed`` the seconds it took to get them and
+    ``not_modified`` tells whether it was a 304.
+    """
+
+    def __init__(self, url, page_size=None, prefetch=None, params=None,
+                 headers=None):
+        if page_size is None:
+            page_size = default_page_size()
+        if prefetch is None:
+            prefetch = default_prefetch()
+
+        self.url = url
+        self.prefetch = max(prefetch, 1)
+        self.params = dict(params or {})
+        if page_size:
+            self.params['page_size'] = page_size
+        self.headers = headers or {}
+        self.response_headers = {}
+        self.elapsed = 0
+        self.not_modified = False
+
+    def __iter__(self):
+        report.log('GET %s %s' % (self.url, self.params or ''))
+        start = time.time()
+        response = client.get(self.url, params=self.params,
+                              headers=self.headers, stream=True)
+        self.elapsed = time.time() - start
+        try:
+            if response.status_code == 304:
+                self.not_modified = True
+                return
+            response.raise_for_status()
+            self.response_headers = response.headers
+
+            chunks = report.stream('GET', self.url,
+                                   response.iter_content(CHUNK_SIZE))
+            head = b''
+            for chunk in chunks:
+                head += chunk
+                if head.strip():
+                    break
+            chunks = chain([head], chunks)
+
+            if head.lstrip().startswith(b'['):
+                for data in iter_array(chunks):
+                    yield data
+                return
+
+            first_page = json.loads(b''.join(chunks).decode('utf-8'))
+        finally:
+            response.close()
+
+        for page in iter_pages(first_page, self.prefetch):
+            for data in page['results']:
+                yield data
+
+
+class DownloadedListing(object):
+    """A listing downloaded in the background, read while it downloads.
+
+    Up to ``PES_DOWNLOAD_RECORDS`` records not read yet are kept as they
+    are, the following ones are spooled as JSON lines to a temporary file,
+    kept in memory up to ``PES_DOWNLOAD_MEMORY`` bytes, so a large listing
+    does not stay in memory while it waits to be used. A listing read as
+    fast as it downloads is never spooled.
+    """
+
+    def __init__(self, listing):
+        self.listing = listing
+        self.condition = threading.Condition()
+        self.records = deque()
+        self.max_records = getattr(settings, 'PES_DOWNLOAD_RECORDS', 1000)
+        self.file = tempfile.SpooledTemporaryFile(max_size=getattr(
+            settings, 'PES_DOWNLOAD_MEMORY', 8 * 1024 * 1024))
+        # Positions in the file of the end of the spooled records and of
+        # the next one to read
+        self.written = 0
+        self.read = 0
+        self.done = False
+        self.error = None
+
+    @property
+    def response_headers(self):
+        return self.listing.response_headers
+
+    @property
+    def elapsed(self):
+        return self.listing.elapsed
+
+    @property
+    def not_modified(self):
+        return self.listing.not_modified
+
+    def _put(self, data):
+        with self.condition:
+            # Records are spooled from the first one that does not fit
+            # until the spool is read, to keep them in order
+            if self.read < self.written or len(self.records) >= \
+                    self.max_records:
+                line = json.dumps(data).encode('utf-8') + b'\n'
+                self.file.seek(self.written)
+                self.file.write(line)
+                self.written += len(line)
+            else:
+                self.records.append(data)
+            self.condition.notify()
+
+    def download(self):
+        try:
+            for data in self.listing:
+                self._put(data)
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify()
+
+    def start(self, pool):
+        pool.apply_async(self.download)
+
+    def _take(self):
+        """Returns the next records once downloaded, none at the end of
+        the listing."""
+        with self.condition:
+            while not self.records and self.read == self.written:
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return []
+                self.condition.wait()
+
+            if self.records:
+                records = list(self.records)
+                self.records.clear()
+                return records
+
+            lines = []
+            self.file.seek(self.read)
+            while self.read < self.written and len(lines) < self.max_records:
+                line = self.file.readline()
+                self.read += len(line)
+                lines.append(line)
+        return [json.loads(line.decode('utf-8')) for line in lines]
+
+    def __iter__(self):
+        try:
+            while True:
+                records = self._take()
+                if not records:
+                    return
+                for data in records:
+                    yield data
+        finally:
+            self.file.close()
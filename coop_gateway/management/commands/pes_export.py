@@ -1,8 +1,12 @@
 # encoding: utf-8
 
+import os
 import sys
+from itertools import islice
+from optparse import make_option
 
 from django.core.management.base import BaseCommand
+from django.db.models import Q
 
 from coop_local.models import (
     Calendar,
@@ -14,34 +18,225 @@ from coop_local.models import (
     Product,
 )
 
-from ...signals import (
-    calendar_saved,
-    event_saved,
-    exchange_saved,
-    location_saved,
-    organization_saved,
-    person_saved,
-    product_saved,
+from ... import report
+from ...dump import (
+    dump_path,
+    read_dump,
+    write_dump,
+)
+from ...models import ExportCheckpoint
+from ...push import (
+    ENDPOINTS,
+    PushBatch,
+    instance_endpoint,
+    serialize_all,
 )
 
 
 class Command(BaseCommand):
     help = 'Exports data to the PES'
-    handlers = (
-        (Location, location_saved),
-        (Person, person_saved),
-        (Organization, organization_saved),
-        (Calendar, calendar_saved),
-        (Event, event_saved),
-        (Product, product_saved),
-        (Exchange, exchange_saved),
+    option_list = BaseCommand.option_list + (
+        make_option('--force', action='store_true', dest='force',
+                    default=False,
+                    help='Send objects even if they did not change'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=None,
+                    help='Send objects by groups of that size to the bulk '
+                         'endpoints of the PES'),
+        make_option('--full', action='store_true', dest='full',
+                    default=False,
+                    help='Export every object, not only the ones changed '
+                         'since the last run'),
+        make_option('--page-size', type='int', dest='page_size',
+                    default=500,
+                    help='Number of objects sent between two checkpoints'),
+        make_option('--workers', type='int', dest='workers', default=1,
+                    help='Number of requests sent concurrently to the PES'),
+        make_option('--to-dump', dest='to_dump', default=None,
+                    metavar='DIR',
+                    help='Write every object to dumps in DIR instead of '
+                         'sending them to the PES'),
+        make_option('--from-dump', dest='from_dump', default=None,
+                    metavar='DIR',
+                    help='Send the records of the dumps in DIR to the PES '
+                         'instead of the local objects'),
+        make_option('--report', dest='report', default=None,
+                    metavar='FILE',
+                    help='Write the timings and counters of the run as '
+                         'JSON to FILE, - for the standard output'),
+    )
+    models = (
+        Location,
+        Person,
+        Organization,
+        Calendar,
+        Event,
+        Product,
+        Exchange,
     )
 
     def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        with report.reporting(report.Report('pes_export'),
+                              verbosity) as run:
+            self.export_all(options)
+
+        if verbosity >= 1 and options['report'] != '-':
+            self.stdout.write(run.summary() + '\n')
+        if options['report']:
+            run.write(options['report'])
+
+    def export_all(self, options):
+        if options['to_dump']:
+            for model in self.models:
+                self.write_dump(model, options['to_dump'],
+                                options['page_size'])
+            return
+
+        batch = PushBatch(force=options['force'],
+                          bulk_size=options['batch_size'],
+                          workers=options['workers'])
+
+        if options['full']:
+            with report.phase('save'):
+                ExportCheckpoint.objects.all().delete()
+
+        try:
+            for model in self.models:
+                if options['from_dump']:
+                    self.send_dump(batch, model, options['from_dump'],
+                                   options['page_size'])
+                else:
+                    self.export(batch, model, options['page_size'])
+        finally:
+            batch.close()
+
+    def serialized(self, model, page_size):
+        """Yields the payloads of every local object of model, serialized
+        page by page."""
+        name = model._meta.object_name
+        queryset = model.objects.filter(foreign_model=None).order_by('pk')
+        last_pk = None
+
+        while True:
+            page = queryset
+            if last_pk is not None:
+                page = page.filter(pk__gt=last_pk)
+            with report.phase('fetch'):
+                page = list(page[:page_size])
+            if not page:
+                return
+            last_pk = page[-1].pk
+
+            errors = {}
+            with report.phase('serialize'):
+                payloads = serialize_all(name, page, errors)
+            for endpoint, e in errors.items():
+                sys.stderr.write('%s %s\n%s\n' % (endpoint,
+                                                   type(e).__name__, e))
+            report.count(name, 'failed', len(errors))
+
+            for instance, data in payloads:
+                yield data
+
+    def write_dump(self, model, directory, page_size):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        name = ENDPOINTS[model._meta.object_name]
+        count = write_dump(directory, name,
+                           self.serialized(model, page_size))
+        report.log('Dump %s %s records Done' % (name, count), 1)
+
+    def send_dump(self, batch, model, directory, page_size):
+        """Sends the records of the dump of model, checkpoints are left
+        untouched."""
+        path = dump_path(directory, ENDPOINTS[model._meta.object_name])
+        if not os.path.exists(path):
+            report.log('No dump %s' % path, 1)
+            return
+
+        records = read_dump(path)
+        while True:
+            with report.phase('fetch'):
+                page = list(islice(records, page_size))
+            if not page:
+                break
+            errors = batch.send(model._meta.object_name, page)
+            for endpoint, e in errors.items():
+                sys.stderr.write('%s %s\n%s\n' % (endpoint,
+                                                   type(e).__name__, e))
+
+    def has_modified(self, model):
+        return 'modified' in model._meta.get_all_field_names()
+
+    def changed(self, model, modified, last_pk):
+        """Returns the objects to export after the given position.
+
+        Models with a modification date are exported by modification, others
+        by pk.
+        """
+        queryset = model.objects.filter(foreign_model=None)
+
+        if not self.has_modified(model):
+            if last_pk is not None:
+                queryset = queryset.filter(pk__gt=last_pk)
+            return queryset.order_by('pk')
+
+        if modified is not None:
+            queryset = queryset.filter(
+                Q(modified__gt=modified)
+                | Q(modified=modified, pk__gt=last_pk or 0)
+            )
+        return queryset.order_by('modified', 'pk')
+
+    def send_page(self, batch, page):
+        """Sends the page, returns the last instance sent before a failure
+        or None."""
+        batch.add_all(page)
+        errors = batch.flush()
+        for endpoint, e in errors.items():
+            sys.stderr.write('%s %s\n%s\n' % (endpoint, type(e).__name__, e))
+
+        last = None
+        for instance in page:
+            endpoint = instance_endpoint(instance._meta.object_name,
+                                         instance.uuid)
+            if endpoint in errors:
+                break
+            last = instance
+        return last
+
+    def export(self, batch, model, page_size):
+        with report.phase('save'):
+            checkpoint, _ = ExportCheckpoint.objects.get_or_create(
+                model_name=model._meta.object_name)
+        has_modified = self.has_modified(model)
+        modified, last_pk = checkpoint.modified, checkpoint.last_pk
+        advancing = True
+
+        while True:
+            with report.phase('fetch'):
+                page = list(self.changed(model, modified,
+                                         last_pk)[:page_size])
+            if not page:
+                break
+
+            last = self.send_page(batch, page)
+            if advancing and last is not None:
+                checkpoint.last_pk = last.pk
+                if has_modified:
+                    checkpoint.modified = last.modified
+                with report.phase('save'):
+                    checkpoint.save()
+            # The next run restarts from the first object that failed
+            advancing = advancing and last is page[-1]
+
+            last_pk = page[-1].pk
+            if has_modified:
+                modified = page[-1].modified
 
-        for model, instance_saved in self.handlers:
-            for instance in model.objects.filter(foreign_model=None).all():
-                try:
-                    instance_saved(None, instance)
-                except Exception as e:
-                    sys.stderr.write('%s\n%s\n' % (type(e).__name__, e))
+        if advancing and not has_modified:
+            # Changes can not be told apart, the next run starts over
+            with report.phase('save'):
+                checkpoint.delete()
@@ -1,19 +1,22 @@
 # encoding: utf-8
 
+import datetime
 import os
+from email.utils import (
+    formatdate,
+    mktime_tz,
+    parsedate_tz,
+)
 import sys
-
-import requests
+import uuid
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
 
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
 from django.core.management.base import BaseCommand
-from django.db import (
-    transaction,
-    DatabaseError,
-    IntegrityError,
-)
-from django.db.models.signals import post_save, post_delete
+from django.db import transaction
+from django.utils import timezone
 
 from coop_local.models import (
     Calendar,
@@ -28,6 +31,20 @@ from coop_local.models import (
     Role,
 )
 
+from ... import (
+    reference,
+    report,
+)
+from ...dump import (
+    DumpListing,
+    endpoint_name,
+    write_dump,
+)
+from ...identity import IdentityMap
+from ...listing import (
+    DownloadedListing,
+    Listing,
+)
 from ...models import (
     ForeignCalendar,
     ForeignEvent,
@@ -37,23 +54,10 @@ from ...models import (
     ForeignPerson,
     ForeignProduct,
     ForeignRole,
+    ImportState,
 )
-from ...signals import (
-    calendar_deleted,
-    calendar_saved,
-    event_deleted,
-    event_saved,
-    exchange_deleted,
-    exchange_saved,
-    location_deleted,
-    location_saved,
-    organization_deleted,
-    organization_saved,
-    person_deleted,
-    person_saved,
-    product_deleted,
-    product_saved,
-)
+from ...reconcile import reconcile
+from ...signals import sync_suspended
 from ...serializers import (
     deserialize_calendar,
     deserialize_contact,
@@ -64,45 +68,121 @@ from ...serializers import (
     deserialize_person,
     deserialize_product,
     deserialize_role,
+    parse_date,
 )
 
 
-def get_or_create_object(model, uuid):
-    try:
-        return model.objects.get(uuid=uuid)
-    except ObjectDoesNotExist:
-        return model(uuid=uuid)
-
-
-def update_contact(content_object, data):
-    contact = get_or_create_object(Contact, uuid=data['uuid'])
-
-    if contact.content_object and contact.content_object != content_object:
-        return
-
-    deserialize_contact(content_object, contact, data)
-    contact.save()
-
-
-def is_old_contact(content_object, contact, contact_uuids):
-    return (
-        contact.uuid not in contact_uuids
-        and contact.content_object == content_object
-    )
-
-
-def delete_old_contacts(content_object, data):
-    contact_uuids = [
-        contact_data['uuid']
-        for contact_data in data
-    ]
-
-    for contact in content_object.contacts.all():
-        if is_old_contact(content_object, contact, contact_uuids):
-            contact.delete()
+def grouped(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        group = list(islice(iterator, size))
+        if not group:
+            return
+        yield group
+
+
+def contact_changes(contact, data):
+    changes = {}
+    if contact.contact_medium_id != data['contact_medium']:
+        changes['contact_medium'] = data['contact_medium']
+    if contact.content != data['content']:
+        changes['content'] = data['content']
+    return changes
+
+
+def update_contacts(content_object, data, bulk=False):
+    """Makes the contacts of content_object match the contact records.
+
+    Contacts belonging to another object are left untouched.
+    """
+    with report.phase('child_sync'):
+        _update_contacts(content_object, data, bulk)
+
+
+def _update_contacts(content_object, data, bulk):
+    uuids = [contact_data['uuid'] for contact_data in data]
+    taken = set(Contact.objects.filter(
+        uuid__in=uuids
+    ).exclude(
+        pk__in=content_object.contacts.values_list('pk', flat=True)
+    ).values_list('uuid', flat=True))
+
+    def build(contact_data):
+        contact = Contact()
+        deserialize_contact(content_object, contact, contact_data)
+        return contact
+
+    reconcile(Contact,
+              content_object.contacts.all(),
+              [
+                  contact_data
+                  for contact_data in data
+                  if contact_data['uuid'] not in taken
+              ],
+              lambda contact: contact.uuid,
+              lambda contact_data: contact_data['uuid'],
+              build,
+              contact_changes,
+              bulk=bulk)
+
+
+def local_datetime(value):
+    """Returns value the way Django stores it: aware with USE_TZ, naive in
+    the default timezone otherwise."""
+    if not isinstance(value, datetime.datetime):
+        value = parse_date(value)
+    default_timezone = timezone.get_default_timezone()
+    if settings.USE_TZ:
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value, default_timezone)
+    elif timezone.is_aware(value):
+        value = timezone.make_naive(value, default_timezone)
+    return value
+
+
+def query_cursor(headers, elapsed):
+    """Returns the modified_since asking for the records changed since the
+    query of a response.
+
+    The PES ran the query between the request and its Date, the cursor is
+    taken back by the time the response took and by ``PES_CURSOR_OVERLAP``
+    seconds, so no record changed meanwhile is missed.
+    """
+    date = parsedate_tz(headers.get('Date', ''))
+    if date is None:
+        return ''
+    overlap = getattr(settings, 'PES_CURSOR_OVERLAP', 60)
+    return formatdate(mktime_tz(date) - elapsed - overlap, usegmt=True)
+
+
+def normalize_datetime(value):
+    """Returns value as a naive UTC datetime, to compare datetimes read from
+    the database and from records."""
+    value = local_datetime(value)
+    if timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+    return value
 
 
 class PesImport(object):
+    page_size = None
+    prefetch = None
+    full = True
+    incremental = True
+    chunk_size = 100
+    engine = 'record'
+    listing = None
+    # Directory of the dumps read instead of the PES
+    dump = None
+    # Objects referenced by the records, shared by the imports of a run
+    identities = None
+    # Whether the objects can be saved without their save method by the
+    # bulk engine, which only writes the values their fields set on save
+    # like modification dates
+    bulk = False
+    # Whether their contacts, engagements or occurrences can be
+    # written without their save method by the bulk engine
+    bulk_children = False
 
     def _before_map(self, instance, data):
         pass
@@ -111,21 +191,57 @@ class PesImport(object):
         pass
 
     def _map(self, instance, data):
-        self._deserialize(instance, data)
+        with report.phase('deserialize'):
+            self._deserialize(instance, data, self.identities)
         self._save(instance)
 
+    def _load_index(self):
+        """Loads the pks of the existing objects by key."""
+        with report.phase('load'):
+            self.index = dict(self.model.objects.values_list(self.key, 'pk'))
+        self.instances = {}
+
+    def _load_instances(self, records):
+        """Loads the existing objects of a chunk of records at once."""
+        with report.phase('load'):
+            self.instances = self.model.objects.in_bulk([
+                self.index[data[self.key]]
+                for data in records
+                if data[self.key] in self.index
+            ])
+
+    def _references(self, data):
+        """Yields the (model, uuid) of the objects referenced by a record."""
+        return ()
+
+    def _preload_references(self, records):
+        """Loads the objects referenced by a chunk of records at once."""
+        references = {}
+        for data in records:
+            for model, uuid in self._references(data):
+                references.setdefault(model, []).append(uuid)
+        with report.phase('load'):
+            for model, uuids in references.items():
+                self.identities.preload(model, uuids)
+
     def _exists(self, data):
-        return bool(self.model.objects.filter(**{
-            self.key: data[self.key]
-        }).values())
+        return data[self.key] in self.index
+
+    def _get(self, data):
+        pk = self.index[data[self.key]]
+        instance = self.instances.get(pk)
+        if instance is None:
+            instance = self.model.objects.get(pk=pk)
+        return instance
 
     def _after_update(self, instance, data):
         pass
 
+    def _is_bulk_children(self):
+        return self.bulk_children and self.engine == 'bulk'
+
     def _update(self, data):
-        instance = self.model.objects.get(**{
-            self.key: data[self.key]
-        })
+        instance = self._get(data)
 
         self._map(instance, data)
         self._after_update(instance, data)
@@ -136,64 +252,330 @@ class PesImport(object):
         self._map(instance, data)
         self._after_map(instance, data)
 
-        self.foreign_model(
-            local_object=instance
-        ).save()
+        with report.phase('save'):
+            self.foreign_model(
+                local_object=instance
+            ).save()
 
         return instance
 
+    def _is_incremental(self):
+        return self.incremental and not self.full
+
+    def url(self):
+        return os.path.join(settings.PES_HOST, self.endpoint)
+
+    def _listing(self):
+        """Returns the listing of the endpoint.
+
+        Incremental imports only ask for the records modified since the
+        previous import, or nothing if the endpoint did not change.
+        """
+        if self.dump is not None:
+            return DumpListing(self.dump, endpoint_name(self.endpoint))
+
+        self.state, _ = ImportState.objects.get_or_create(
+            endpoint=self.endpoint)
+        params, headers = {}, {}
+
+        if self._is_incremental():
+            if self.state.etag:
+                headers['If-None-Match'] = self.state.etag
+            if self.state.last_modified:
+                headers['If-Modified-Since'] = self.state.last_modified
+            if self.state.cursor:
+                params['modified_since'] = self.state.cursor
+
+        return Listing(self.url(), self.page_size, self.prefetch, params,
+                       headers)
+
+    def start_download(self, pool):
+        """Downloads the records in the pool until they are used."""
+        self.listing = DownloadedListing(self._listing())
+        self.listing.start(pool)
+
     def get_data(self):
-        url = os.path.join(settings.PES_HOST, self.endpoint)
-        sys.stdout.write('GET %s\n' % url)
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
+        if self.listing is None:
+            self.listing = self._listing()
+        return self.listing
+
+    def save_state(self):
+        # A dump does not tell what changed on the PES since
+        if self.listing.not_modified or self.dump is not None:
+            return
+
+        headers = self.listing.response_headers
+        self.state.etag = headers.get('ETag', '')
+        self.state.last_modified = headers.get('Last-Modified', '')
+        # The clock of the PES, records modified from then on may not be
+        # in this import
+        self.state.cursor = query_cursor(headers, self.listing.elapsed)
+        self.state.save()
+
+    def _apply_one(self, data):
+        """Applies a record, returns the object if it was created."""
+        instance_info = (self.model.__name__, data[self.key])
+        if self._exists(data):
+            self._update(data)
+            report.log('Update %s %s Done' % instance_info)
+            return None
+
+        instance = self._create(data)
+        report.log('Create %s %s Done' % instance_info)
+        return instance
+
+    def _apply_chunk(self, records):
+        """Applies the records in one savepoint, returns the number of
+        records that failed.
+
+        When the savepoint fails, each half of the records is applied the
+        same way until the failing records are isolated.
+        """
+        created = []
+        sid = transaction.savepoint()
+        try:
+            for data in records:
+                instance = self._apply_one(data)
+                if instance is not None:
+                    self.index[data[self.key]] = instance.pk
+                    created.append(data[self.key])
+            transaction.savepoint_commit(sid)
+        except Exception as e:
+            transaction.savepoint_rollback(sid)
+            for key in created:
+                del self.index[key]
+
+            if len(records) == 1:
+                sys.stderr.write('%s\n%s\n' % (type(e).__name__, e))
+                report.count(self.model.__name__, 'failed')
+                return 1
+        else:
+            report.count(self.model.__name__, 'created', len(created))
+            report.count(self.model.__name__, 'updated',
+                         len(records) - len(created))
+            return 0
+
+        middle = len(records) // 2
+        return (self._apply_chunk(records[:middle])
+                + self._apply_chunk(records[middle:]))
+
+    def _after_bulk_create(self, instance, data):
+        pass
+
+    def _after_bulk_update(self, instance, data):
+        self._after_update(instance, data)
+
+    def _bulk_create(self, records):
+        """Creates the objects of the records with one INSERT, returns the
+        records to apply one by one."""
+        if not records:
+            return []
+
+        keys = [data[self.key] for data in records]
+        sid = transaction.savepoint()
+        try:
+            instances = []
+            with report.phase('deserialize'):
+                for data in records:
+                    instance = self.model()
+                    self._deserialize(instance, data, self.identities)
+                    instances.append(instance)
+
+            with report.phase('save'):
+                self.model.objects.bulk_create(instances)
+                pks = dict(self.model.objects.filter(**{
+                    '%s__in' % self.key: keys
+                }).values_list(self.key, 'pk'))
+                self.foreign_model.objects.bulk_create([
+                    self.foreign_model(local_object_id=pks[key])
+                    for key in keys
+                ])
+
+            for instance, data in zip(instances, records):
+                instance.pk = pks[data[self.key]]
+                self._after_bulk_create(instance, data)
+            transaction.savepoint_commit(sid)
+        except Exception as e:
+            sys.stderr.write('%s\n%s\n' % (type(e).__name__, e))
+            transaction.savepoint_rollback(sid)
+            return records
+
+        self.index.update(pks)
+        report.count(self.model.__name__, 'created', len(records))
+        report.log('Create %s %s objects Done' % (self.model.__name__,
+                                                   len(records)))
+        return []
+
+    def _changes(self, instance, fields, before):
+        changes = {}
+        for field, value in zip(fields, before):
+            new_value = getattr(instance, field.attname)
+            try:
+                changed = new_value != value
+            except TypeError:
+                changed = True
+            if changed:
+                changes[field.name] = getattr(instance, field.name)
+        return changes
+
+    def _pre_save_changes(self, instance, fields):
+        """Returns the values the fields set when the object is saved, like
+        modification dates."""
+        before = [getattr(instance, field.attname) for field in fields]
+        for field in fields:
+            setattr(instance, field.attname, field.pre_save(instance, False))
+        return self._changes(instance, fields, before)
+
+    def _bulk_update(self, records):
+        """Updates the changed fields of the existing objects of the records
+        without saving them, returns the records to apply one by one."""
+        if not records:
+            return []
+
+        fields = [
+            field
+            for field in self.model._meta.local_fields
+            if not field.primary_key
+        ]
+        sid = transaction.savepoint()
+        try:
+            for data in records:
+                instance = self._get(data)
+                before = [getattr(instance, field.attname) for field in fields]
+                with report.phase('deserialize'):
+                    self._deserialize(instance, data, self.identities)
+                changes = self._changes(instance, fields, before)
+                if changes:
+                    changes.update(self._pre_save_changes(instance, fields))
+                    with report.phase('save'):
+                        self.model.objects.filter(pk=instance.pk).update(
+                            **changes)
+                self._after_bulk_update(instance, data)
+            transaction.savepoint_commit(sid)
+        except Exception as e:
+            sys.stderr.write('%s\n%s\n' % (type(e).__name__, e))
+            transaction.savepoint_rollback(sid)
+            return records
+
+        report.count(self.model.__name__, 'updated', len(records))
+        report.log('Update %s %s objects Done' % (self.model.__name__,
+                                                   len(records)))
+        return []
+
+    def _apply_bulk(self, records):
+        """Applies a chunk of records together, returns the records to
+        apply one by one."""
+        seen = set()
+        created, updated, remaining = [], [], []
+        for data in records:
+            if data[self.key] in seen:
+                remaining.append(data)
+                continue
+            seen.add(data[self.key])
+            if self._exists(data):
+                updated.append(data)
+            else:
+                created.append(data)
+
+        return (self._bulk_create(created)
+                + self._bulk_update(updated)
+                + remaining)
 
     @transaction.commit_manually
     def handle(self):
         keys = []
+        failed = False
+        self._load_index()
+        bulk = self.bulk and self.engine == 'bulk'
+        if self.identities is None:
+            self.identities = IdentityMap()
+
+        records = report.timed('fetch', self.get_data())
+        for records in grouped(records, self.chunk_size):
+            self._load_instances(records)
+            self._preload_references(records)
+            keys.extend(data[self.key] for data in records)
+
+            if bulk:
+                records = self._apply_bulk(records)
+            if records and self._apply_chunk(records):
+                failed = True
+            # Locks are only held for a chunk
+            with report.phase('save'):
+                transaction.commit()
+
+        # Records missing from a partial listing are not deleted upstream
+        if not self._is_incremental() and not self.listing.not_modified:
+            self.delete_missing(keys)
+
+        # Failed records are asked again by the next import
+        if not failed:
+            self.save_state()
+
+        with report.phase('save'):
+            transaction.commit()
+
+    def _save(self, instance):
+        with report.phase('save'):
+            instance.save()
+
+    def _delete(self, instance):
+        instance.delete()
+
+    def _delete_many(self, pks):
+        self.model.objects.filter(pk__in=pks).delete()
+
+    def _mark_seen(self, keys, run_id):
+        pks = [self.index[key] for key in keys if key in self.index]
+        for chunk in grouped(pks, 500):
+            self.foreign_model.objects.filter(
+                local_object__in=chunk
+            ).update(seen_run=run_id)
 
-        for data in self.get_data():
-            keys.append(data[self.key])
+    def delete_missing(self, keys):
+        """Deletes the imported objects missing from keys.
+
+        The imported objects seen in this import are marked with its id,
+        the others are deleted together, or one by one when deleting them
+        together fails.
+        """
+        with report.phase('delete_missing'):
+            self._delete_missing(keys)
+
+    def _delete_missing(self, keys):
+        run_id = uuid.uuid4().hex
+        self._mark_seen(keys, run_id)
+        missing = list(self.foreign_model.objects.exclude(
+            seen_run=run_id
+        ).values_list('local_object', flat=True))
+
+        for chunk in grouped(missing, 500):
+            self.identities.forget(self.model, chunk)
             try:
-                instance_info = (self.model.__name__, data[self.key])
                 sid = transaction.savepoint()
-                if self._exists(data):
-                    sys.stdout.write('Update %s %s ' % instance_info)
-                    self._update(data)
-                else:
-                    sys.stdout.write('Create %s %s ' % instance_info)
-                    self._create(data)
+                self._delete_many(chunk)
                 transaction.savepoint_commit(sid)
-                sys.stdout.write('Done\n')
-            except DatabaseError as e:
-                sys.stderr.write('DatabaseError\n%s\n' % e)
-                transaction.savepoint_rollback(sid)
-            except IntegrityError as e:
-                sys.stderr.write('IntegrityError\n%s\n' % e)
-                transaction.savepoint_rollback(sid)
+                report.count(self.model.__name__, 'deleted', len(chunk))
+                report.log('Delete %s %s objects Done' % (
+                    self.model.__name__, len(chunk)))
+                continue
             except Exception as e:
                 sys.stderr.write('%s\n%s\n' % (type(e).__name__, e))
                 transaction.savepoint_rollback(sid)
 
-        self.delete_missing(keys)
-
-        transaction.commit()
-
-    def delete_missing(self, keys):
-        for foreign_model in self.foreign_model.objects.all():
-            key = getattr(foreign_model.local_object, self.key, None)
-            if key not in keys:
+            for instance in self.model.objects.filter(pk__in=chunk):
                 try:
                     sid = transaction.savepoint()
-                    instance_info = (self.model.__name__, key)
-                    sys.stdout.write('Delete %s %s ' % instance_info)
-                    self._delete(foreign_model.local_object)
-                    sys.stdout.write('Done\n')
+                    instance_info = (self.model.__name__,
+                                     getattr(instance, self.key, None))
+                    self._delete(instance)
                     transaction.savepoint_commit(sid)
+                    report.count(self.model.__name__, 'deleted')
+                    report.log('Delete %s %s Done' % instance_info)
                 except Exception as e:
                     sys.stderr.write('%s\n%s\n' % (type(e).__name__, e))
                     transaction.savepoint_rollback(sid)
+                    report.count(self.model.__name__, 'failed')
 
 
 class HasContacts(object):
@@ -201,13 +583,20 @@ class HasContacts(object):
     def _before_map(self, instance, data):
         self._save(instance)
 
+    def _references(self, data):
+        for field in ('pref_email', 'pref_phone'):
+            if data.get(field):
+                yield Contact, data[field]
+
     def _update_contacts(self, content_object, data):
-        if 'contacts' in data:
-            for contact_data in data['contacts']:
-                update_contact(content_object, contact_data)
+        update_contacts(content_object, data.get('contacts', []),
+                        self._is_bulk_children())
 
     def _after_update(self, instance, data):
-        delete_old_contacts(instance, data.get('contacts', []))
+        self._update_contacts(instance, data)
+
+    def _after_bulk_create(self, instance, data):
+        self._update_contacts(instance, data)
 
 
 class PesImportOrganisations(HasContacts, PesImport):
@@ -218,39 +607,58 @@ class PesImportOrganisations(HasContacts, PesImport):
 
     _deserialize = staticmethod(deserialize_organization)
 
-    def _save(self, organization):
-        post_save.disconnect(organization_saved, Organization)
-        organization.save()
-        post_save.connect(organization_saved, Organization)
-
-    def _delete(self, organization):
-        post_delete.disconnect(organization_deleted, Organization)
-        organization.delete()
-        post_delete.connect(organization_deleted, Organization)
-
-    def _delete_old_engagements(self, organization):
-        Engagement.objects.filter(organization=organization).delete()
-
-    def _create_engagement(self, organization, data):
-        person = Person.objects.get(uuid=data['person'])
-        role_uuid = self.translations['roles'].get(data['role'])
-        if role_uuid:
-            role = Role.objects.filter(uuid=role_uuid)[0]
-        else:
-            role = None
-
-        engagement = Engagement(organization=organization,
-                                person=person,
-                                role=role,
-                                role_detail=data.get('role_detail', ''))
-        engagement.save()
+    def _references(self, data):
+        for reference in super(PesImportOrganisations, self)._references(
+                data):
+            yield reference
+        for member in data.get('members', []):
+            yield Person, member['person']
+            role_uuid = self.translations['roles'].get(member['role'])
+            if role_uuid:
+                yield Role, role_uuid
+
+    def _engagement_changes(self, engagement, data):
+        role_detail = data.get('role_detail', '')
+        if engagement.role_detail != role_detail:
+            return {'role_detail': role_detail}
+        return {}
 
     def _update_members(self, organization, data):
-        if 'members' in data:
-            self._delete_old_engagements(organization)
-
-            for engagement_data in data['members']:
-                self._create_engagement(organization, engagement_data)
+        if 'members' not in data:
+            return
+
+        with report.phase('child_sync'):
+            self._reconcile_members(organization, data['members'])
+
+    def _reconcile_members(self, organization, members):
+        roles = self.translations['roles']
+
+        def build(member):
+            person = self.identities.get(Person, member['person'])
+            if person is None:
+                raise Person.DoesNotExist(member['person'])
+            return Engagement(organization=organization,
+                              person=person,
+                              role=self.identities.get(
+                                  Role, roles.get(member['role'])),
+                              role_detail=member.get('role_detail', ''))
+
+        reconcile(Engagement,
+                  Engagement.objects.filter(
+                      organization=organization
+                  ).select_related('person', 'role'),
+                  members,
+                  lambda engagement: (engagement.person.uuid,
+                                      getattr(engagement.role, 'uuid', None)),
+                  lambda member: (member['person'],
+                                  roles.get(member['role']) or None),
+                  build,
+                  self._engagement_changes,
+                  bulk=self._is_bulk_children())
+
+    def _after_update(self, organization, data):
+        self._update_members(organization, data)
+        self._update_contacts(organization, data)
 
     def _after_map(self, organization, data):
         self._update_members(organization, data)
@@ -263,19 +671,10 @@ class PesImportPersons(HasContacts, PesImport):
     model = Person
     foreign_model = ForeignPerson
     key = 'uuid'
+    bulk = True
 
     _deserialize = staticmethod(deserialize_person)
 
-    def _save(self, person):
-        post_save.disconnect(person_saved, Person)
-        person.save()
-        post_save.connect(person_saved, Person)
-
-    def _delete(self, person):
-        post_delete.disconnect(person_deleted, Person)
-        person.delete()
-        post_delete.connect(person_deleted, Person)
-
     def _after_map(self, organization, data):
         self._update_contacts(organization, data)
         self._save(organization)
@@ -286,31 +685,37 @@ class PesImportRoles(PesImport):
     model = Role
     foreign_model = ForeignRole
     key = 'label'
+    # Every role is needed to translate the roles of the engagements
+    incremental = False
 
     _deserialize = staticmethod(deserialize_role)
 
     def __init__(self):
         self.translations = {}
 
-    def _save(self, role):
-        role.save()
-
-    def _delete(self, role):
-        role.delete()
+    def _load_index(self):
+        """Loads the uuids of the existing roles by label."""
+        self.index = {}
+        with report.phase('load'):
+            roles = list(Role.objects.values_list('label', 'uuid'))
+        for label, role_uuid in roles:
+            self.index.setdefault(label, role_uuid)
 
     def handle(self):
-        for data in self.get_data():
+        self._load_index()
+
+        for data in report.timed('fetch', self.get_data()):
+            instance_info = (self.model.__name__, data['uuid'])
             if self._exists(data):
-                sys.stdout.write('Update %s %s ' % (self.model.__name__,
-                                                    data['uuid']))
-                role = Role.objects.filter(label=data['label'])[0]
+                report.count(self.model.__name__, 'updated')
+                report.log('Update %s %s Done' % instance_info)
             else:
-                sys.stdout.write('Create %s %s ' % (self.model.__name__,
-                                                    data['uuid']))
                 role = self._create(data)
+                self.index[data['label']] = role.uuid
+                report.count(self.model.__name__, 'created')
+                report.log('Create %s %s Done' % instance_info)
 
-            self.translations[data['uuid']] = role.uuid
-            sys.stdout.write('Done\n')
+            self.translations[data['uuid']] = self.index[data['label']]
 
 
 class PesImportCalendars(PesImport):
@@ -318,19 +723,10 @@ class PesImportCalendars(PesImport):
     model = Calendar
     foreign_model = ForeignCalendar
     key = 'uuid'
+    bulk = True
 
     _deserialize = staticmethod(deserialize_calendar)
 
-    def _save(self, calendar):
-        post_save.disconnect(calendar_saved, Calendar)
-        calendar.save()
-        post_save.connect(calendar_saved, Calendar)
-
-    def _delete(self, calendar):
-        post_delete.disconnect(calendar_deleted, Calendar)
-        calendar.delete()
-        post_delete.connect(calendar_deleted, Calendar)
-
 
 class PesImportEvents(PesImport):
     endpoint = 'api/events/'
@@ -340,34 +736,63 @@ class PesImportEvents(PesImport):
 
     _deserialize = staticmethod(deserialize_event)
 
+    def _references(self, data):
+        if data.get('calendar'):
+            yield Calendar, data['calendar']
+        if data.get('organization'):
+            yield Organization, data['organization']
+        for organization_uuid in data.get('organizations') or []:
+            yield Organization, organization_uuid
+
     def _before_map(self, event, data):
-        event.calendar = Calendar.objects.get(uuid=data['calendar'])
+        calendar = self.identities.get(Calendar, data['calendar'])
+        if calendar is None:
+            raise Calendar.DoesNotExist(data['calendar'])
+        event.calendar = calendar
         self._save(event)
 
     def is_valid_occurrence_data(self, occurrence_data):
         return occurrence_data.get('start_time') \
             and occurrence_data.get('end_time')
 
+    def _update_occurrences(self, event, data):
+        if 'occurrences' not in data:
+            return
+
+        occurrences = [
+            occurrence_data
+            for occurrence_data in data['occurrences'] or []
+            if self.is_valid_occurrence_data(occurrence_data)
+        ]
+        with report.phase('child_sync'):
+            self._reconcile_occurrences(event, occurrences)
+
+    def _reconcile_occurrences(self, event, occurrences):
+        occurrence_model = event.occurrence_set.model
+
+        def build(occurrence_data):
+            return occurrence_model(
+                event=event,
+                start_time=local_datetime(occurrence_data['start_time']),
+                end_time=local_datetime(occurrence_data['end_time']))
+
+        reconcile(occurrence_model,
+                  event.occurrence_set.all(),
+                  occurrences,
+                  lambda occurrence: (
+                      normalize_datetime(occurrence.start_time),
+                      normalize_datetime(occurrence.end_time)),
+                  lambda occurrence_data: (
+                      normalize_datetime(occurrence_data['start_time']),
+                      normalize_datetime(occurrence_data['end_time'])),
+                  build,
+                  bulk=self._is_bulk_children())
+
     def _after_map(self, event, data):
-        if 'occurrences' in data:
-            event.occurrence_set.filter().delete()
-            if data['occurrences']:
-                for occurrence_data in data['occurrences']:
-                    if self.is_valid_occurrence_data(occurrence_data):
-                        event.add_occurrences(
-                            start_time=occurrence_data['start_time'],
-                            end_time=occurrence_data['end_time']
-                        )
-
-    def _save(self, event):
-        post_save.disconnect(event_saved, Event)
-        event.save()
-        post_save.connect(event_saved, Event)
-
-    def _delete(self, event):
-        post_delete.disconnect(event_deleted, Event)
-        event.delete()
-        post_delete.connect(event_deleted, Event)
+        self._update_occurrences(event, data)
+
+    def _after_update(self, event, data):
+        self._update_occurrences(event, data)
 
 
 class PesImportExchanges(PesImport):
@@ -375,37 +800,23 @@ class PesImportExchanges(PesImport):
     model = Exchange
     foreign_model = ForeignExchange
     key = 'uuid'
+    bulk = True
 
     _deserialize = staticmethod(deserialize_exchange)
 
-    def _save(self, exchange):
-        post_save.disconnect(exchange_saved, Exchange)
-        exchange.save()
-        post_save.connect(exchange_saved, Exchange)
-
-    def _delete(self, exchange):
-        post_delete.disconnect(exchange_deleted, Exchange)
-        exchange.delete()
-        post_delete.connect(exchange_deleted, Exchange)
-
 
 class PesImportProducts(PesImport):
     endpoint = 'api/products/'
     model = Product
     foreign_model = ForeignProduct
     key = 'uuid'
+    bulk = True
 
     _deserialize = staticmethod(deserialize_product)
 
-    def _save(self, product):
-        post_save.disconnect(product_saved, Product)
-        product.save()
-        post_save.connect(product_saved, Product)
-
-    def _delete(self, product):
-        post_delete.disconnect(product_deleted, Product)
-        product.delete()
-        post_delete.connect(product_deleted, Product)
+    def _references(self, data):
+        if data.get('organization'):
+            yield Organization, data['organization']
 
 
 class PesImportLocations(PesImport):
@@ -413,66 +824,188 @@ class PesImportLocations(PesImport):
     model = Location
     foreign_model = ForeignLocation
     key = 'uuid'
+    bulk = True
 
     _deserialize = staticmethod(deserialize_location)
 
-    def _save(self, location):
-        post_save.disconnect(location_saved, Location)
-        location.save()
-        post_save.connect(location_saved, Location)
-
-    def _delete(self, location):
-        post_delete.disconnect(location_deleted, Location)
-        location.delete()
-        post_delete.connect(location_deleted, Location)
-
 
 class PesImportCommand(BaseCommand):
     help = 'Imports data from the PES'
+    option_list = BaseCommand.option_list + (
+        make_option('--page-size', type='int', dest='page_size',
+                    default=None,
+                    help='Number of records asked per page to paginated '
+                         'endpoints'),
+        make_option('--prefetch', type='int', dest='prefetch',
+                    default=None,
+                    help='Number of pages downloaded ahead'),
+        make_option('--fetch-workers', type='int', dest='fetch_workers',
+                    default=8,
+                    help='Number of endpoints downloaded at once while '
+                         'the previous ones are imported, 1 to download '
+                         'each one when it is imported'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=100,
+                    help='Number of records imported per transaction'),
+        make_option('--engine', type='choice', choices=['record', 'bulk'],
+                    dest='engine', default='record',
+                    help='record saves each record, bulk inserts and '
+                         'updates the records of a chunk together when '
+                         'the model allows it'),
+        make_option('--full', action='store_true', dest='full',
+                    default=False,
+                    help='Import every record and delete the ones missing '
+                         'from the PES, not only the changes since the '
+                         'last import'),
+        make_option('--to-dump', dest='to_dump', default=None,
+                    metavar='DIR',
+                    help='Write every record of the PES to dumps in DIR '
+                         'instead of importing them'),
+        make_option('--from-dump', dest='from_dump', default=None,
+                    metavar='DIR',
+                    help='Import the records of the dumps in DIR instead '
+                         'of the PES'),
+        make_option('--report', dest='report', default=None,
+                    metavar='FILE',
+                    help='Write the timings and counters of the run as '
+                         'JSON to FILE, - for the standard output'),
+    )
+
+    handler_classes = (
+        PesImportLocations,
+        PesImportRoles,
+        PesImportPersons,
+        PesImportOrganisations,
+        PesImportCalendars,
+        PesImportEvents,
+        PesImportProducts,
+        PesImportExchanges,
+    )
+
+    def handler(self, handler_class):
+        handler = self.handlers.get(handler_class)
+        if handler is None:
+            handler = self.handlers[handler_class] = handler_class()
+            handler.identities = self.identities
+            handler.page_size = self.options['page_size']
+            handler.prefetch = self.options['prefetch']
+            handler.full = self.options['full']
+            handler.engine = self.options['engine']
+            handler.dump = self.options['from_dump']
+        handler.chunk_size = self.options['chunk_size']
+        return handler
+
+    def start_downloads(self, pool):
+        for handler_class in self.handler_classes:
+            self.handler(handler_class).start_download(pool)
+
+    def write_dumps(self, directory):
+        """Writes the full listings of the PES to dumps, downloading them
+        at once."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        listings = [
+            (endpoint_name(handler_class.endpoint),
+             Listing(self.handler(handler_class).url(),
+                     self.options['page_size'], self.options['prefetch']))
+            for handler_class in self.handler_classes
+        ]
+        # Roles are dumped with the import endpoints
+        listings.append((reference.legal_statuses.name,
+                         Listing(reference.legal_statuses.url())))
+
+        def write(listing):
+            name, records = listing
+            count = write_dump(directory, name, records)
+            report.log('Dump %s %s records Done' % (name, count), 1)
+
+        pool = ThreadPool(max(self.options['fetch_workers'], 1))
+        try:
+            pool.map(write, listings)
+        finally:
+            pool.terminate()
 
     def import_roles(self):
-        handler = PesImportRoles()
+        handler = self.handler(PesImportRoles)
         handler.handle()
         self.translations['roles'] = handler.translations
 
     def import_organizations(self):
-        handler = PesImportOrganisations()
+        handler = self.handler(PesImportOrganisations)
         handler.translations = self.translations
         handler.handle()
 
     def import_persons(self):
-        handler = PesImportPersons()
+        handler = self.handler(PesImportPersons)
         handler.handle()
 
     def import_calendar(self):
-        handler = PesImportCalendars()
+        handler = self.handler(PesImportCalendars)
         handler.handle()
 
     def import_events(self):
-        handler = PesImportEvents()
+        handler = self.handler(PesImportEvents)
         handler.handle()
 
     def import_products(self):
-        handler = PesImportProducts()
+        handler = self.handler(PesImportProducts)
         handler.handle()
 
     def import_exchanges(self):
-        handler = PesImportExchanges()
+        handler = self.handler(PesImportExchanges)
         handler.handle()
 
     def import_locations(self):
-        handler = PesImportLocations()
+        handler = self.handler(PesImportLocations)
         handler.handle()
 
     def handle(self, *args, **options):
+        self.options = options
         self.translations = {}
-        self.import_locations()
-        self.import_roles()
-        self.import_persons()
-        self.import_organizations()
-        self.import_calendar()
-        self.import_events()
-        self.import_products()
-        self.import_exchanges()
+        self.handlers = {}
+        self.identities = IdentityMap()
+
+        verbosity = int(options.get('verbosity', 1))
+        with report.reporting(report.Report('pes_import'),
+                              verbosity) as run:
+            if options['to_dump']:
+                self.write_dumps(options['to_dump'])
+            else:
+                self.import_all()
+
+        if verbosity >= 1 and options['report'] != '-':
+            self.stdout.write(run.summary() + '\n')
+        if options['report']:
+            run.write(options['report'])
+
+    def import_all(self):
+        options = self.options
+
+        if options['from_dump']:
+            # The reference data of the PES comes from the dumps too
+            for data in (reference.roles, reference.legal_statuses):
+                data.use_dump(options['from_dump'])
+
+        # Downloads do not depend on each other, only imports do
+        pool = None
+        if options['fetch_workers'] > 1 and not options['from_dump']:
+            pool = ThreadPool(options['fetch_workers'])
+            self.start_downloads(pool)
+
+        try:
+            # Imported changes come from the PES, they are not sent back
+            with sync_suspended():
+                self.import_locations()
+                self.import_roles()
+                self.import_persons()
+                self.import_organizations()
+                self.import_calendar()
+                self.import_events()
+                self.import_products()
+                self.import_exchanges()
+        finally:
+            if pool is not None:
+                pool.terminate()
 
 Command = PesImportCommand
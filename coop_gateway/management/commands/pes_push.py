@@ -0,0 +1,32 @@
+# encoding: utf-8
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ...outbox import drain
+
+
+class Command(BaseCommand):
+    help = 'Sends the changes queued in the outbox to the PES'
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=None,
+                    help='Maximum number of queued changes to send'),
+        make_option('--max-attempts', type='int', dest='max_attempts',
+                    default=None,
+                    help='Skip changes that already failed that many times'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=None,
+                    help='Send and delete objects by groups of that size '
+                         'with the bulk endpoints of the PES'),
+        make_option('--workers', type='int', dest='workers', default=1,
+                    help='Number of requests sent concurrently to the PES'),
+    )
+
+    def handle(self, *args, **options):
+        done, failed = drain(limit=options['limit'],
+                             max_attempts=options['max_attempts'],
+                             bulk_size=options['batch_size'],
+                             workers=options['workers'])
+        if int(options.get('verbosity', 1)) > 1:
+            self.stdout.write('%s sent, %s failed\n' % (done, failed))
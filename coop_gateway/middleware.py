@@ -0,0 +1,22 @@
+from coop_gateway.outbox import coalesce
+
+
+class CoalescePushesMiddleware(object):
+    """Queues the objects changed by a request once, when it ends."""
+
+    def process_request(self, request):
+        request._coop_gateway_coalesce = coalesce()
+        request._coop_gateway_coalesce.__enter__()
+
+    def _exit(self, request):
+        context = getattr(request, '_coop_gateway_coalesce', None)
+        if context is not None:
+            del request._coop_gateway_coalesce
+            context.__exit__(None, None, None)
+
+    def process_response(self, request, response):
+        self._exit(request)
+        return response
+
+    def process_exception(self, request, exception):
+        self._exit(request)
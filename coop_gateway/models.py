@@ -2,43 +2,86 @@ from django.db import models
 from django.db.models.loading import get_model
 
 
-class ForeignOrganization(models.Model):
+class ForeignModel(models.Model):
+    # Id of the last full import listing the object
+    seen_run = models.CharField(max_length=32, blank=True, db_index=True)
+
+    class Meta:
+        abstract = True
+
+
+class ForeignOrganization(ForeignModel):
     local_object = models.OneToOneField(
         get_model('coop_local', 'Organization'),
         related_name='foreign_model'
     )
 
 
-class ForeignPerson(models.Model):
+class ForeignPerson(ForeignModel):
     local_object = models.OneToOneField(get_model('coop_local', 'Person'),
                                         related_name='foreign_model')
 
 
-class ForeignRole(models.Model):
+class ForeignRole(ForeignModel):
     local_object = models.OneToOneField(get_model('coop_local', 'Role'),
                                         related_name='foreign_model')
 
 
-class ForeignCalendar(models.Model):
+class ForeignCalendar(ForeignModel):
     local_object = models.OneToOneField(get_model('coop_local', 'Calendar'),
                                         related_name='foreign_model')
 
 
-class ForeignEvent(models.Model):
+class ForeignEvent(ForeignModel):
     local_object = models.OneToOneField(get_model('coop_local', 'Event'),
                                         related_name='foreign_model')
 
 
-class ForeignProduct(models.Model):
+class ForeignProduct(ForeignModel):
     local_object = models.OneToOneField(get_model('coop_local', 'Product'),
                                         related_name='foreign_model')
 
 
-class ForeignExchange(models.Model):
+class ForeignExchange(ForeignModel):
     local_object = models.OneToOneField(get_model('coop_local', 'Exchange'),
                                         related_name='foreign_model')
 
 
-class ForeignLocation(models.Model):
+class ForeignLocation(ForeignModel):
     local_object = models.OneToOneField(get_model('coop_local', 'Location'),
                                         related_name='foreign_model')
+
+
+class OutboxEntry(models.Model):
+    ACTIONS = (
+        ('push', 'push'),
+        ('delete', 'delete'),
+    )
+
+    model_name = models.CharField(max_length=50)
+    uuid = models.CharField(max_length=50)
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ('pk',)
+
+
+class PushedPayload(models.Model):
+    endpoint = models.CharField(max_length=100, unique=True)
+    digest = models.CharField(max_length=40)
+
+
+class ExportCheckpoint(models.Model):
+    model_name = models.CharField(max_length=50, unique=True)
+    modified = models.DateTimeField(null=True)
+    last_pk = models.PositiveIntegerField(null=True)
+
+
+class ImportState(models.Model):
+    endpoint = models.CharField(max_length=100, unique=True)
+    etag = models.CharField(max_length=200, blank=True)
+    last_modified = models.CharField(max_length=50, blank=True)
+    cursor = models.CharField(max_length=50, blank=True)
@@ -0,0 +1,146 @@
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db.models.loading import get_model
+
+from coop_gateway.models import OutboxEntry
+from coop_gateway.push import (
+    ENDPOINTS,
+    PushBatch,
+    instance_endpoint,
+)
+
+
+_local = threading.local()
+
+
+def _write(pending):
+    OutboxEntry.objects.bulk_create([
+        OutboxEntry(model_name=model_name, uuid=uuid, action=action)
+        for (model_name, uuid), action in pending.items()
+    ])
+
+
+@contextmanager
+def coalesce():
+    """Queues each changed object once, when the block exits.
+
+    Saving the same object several times in the block, or saving and then
+    deleting it, results in a single outbox entry with the last action.
+    """
+    if getattr(_local, 'pending', None) is not None:
+        yield
+        return
+
+    _local.pending = OrderedDict()
+    try:
+        yield
+    finally:
+        pending, _local.pending = _local.pending, None
+        if pending:
+            _write(pending)
+
+
+def enqueue(action, instance):
+    # Contacts can belong to objects the PES does not know of
+    if instance is None or instance._meta.object_name not in ENDPOINTS:
+        return
+
+    key = (instance._meta.object_name, instance.uuid)
+    pending = getattr(_local, 'pending', None)
+
+    if pending is None:
+        _write({key: action})
+    else:
+        pending.pop(key, None)
+        pending[key] = action
+
+
+def enqueue_push(instance):
+    enqueue('push', instance)
+
+
+def enqueue_delete(instance):
+    enqueue('delete', instance)
+
+
+def _add_all(batch, model_name, uuids):
+    """Adds the objects of model_name with the given uuids, loading them
+    together. Objects deleted since they were queued are skipped, their
+    delete entry follows."""
+    model = get_model('coop_local', model_name)
+    instances = list(model.objects.filter(uuid__in=uuids))
+    if instances:
+        batch.add_all(instances)
+
+
+def drain(limit=None, max_attempts=None, bulk_size=None, workers=1):
+    """Sends the queued changes to the PES, returns the number of objects
+    sent and failed.
+
+    With a ``bulk_size``, the objects are pushed and deleted by groups of
+    that size, sent by ``workers`` concurrently, see PushBatch.
+    """
+    entries = OutboxEntry.objects.all()
+    if max_attempts is not None:
+        entries = entries.filter(attempts__lt=max_attempts)
+    if limit is not None:
+        entries = entries[:limit]
+
+    # The last entry queued for an object wins
+    groups = OrderedDict()
+    for entry in entries:
+        groups.setdefault((entry.model_name, entry.uuid), []).append(entry)
+
+    pushed = OrderedDict()
+    deleted = []
+    # Errors of the entries that can not be sent, by (model_name, uuid)
+    entry_errors = {}
+    for (model_name, uuid), group in groups.items():
+        if model_name not in ENDPOINTS:
+            entry_errors[model_name, uuid] = ValueError(
+                'No PES endpoint for %s' % model_name)
+        elif group[-1].action == 'delete':
+            deleted.append((model_name, uuid))
+        else:
+            pushed.setdefault(model_name, []).append(uuid)
+
+    batch = PushBatch(bulk_size=bulk_size, workers=workers)
+    errors = {}
+    for model_name, uuids in pushed.items():
+        try:
+            _add_all(batch, model_name, uuids)
+        except Exception as e:
+            for uuid in uuids:
+                errors[instance_endpoint(model_name, uuid)] = e
+    # Deleted objects are not sent again as the dependency of another one
+    for model_name, uuid in deleted:
+        batch.delete(model_name, uuid)
+    try:
+        errors.update(batch.flush())
+    finally:
+        batch.close()
+
+    done = failed = 0
+    for (model_name, uuid), group in groups.items():
+        e = entry_errors.get((model_name, uuid))
+        if e is None and model_name in ENDPOINTS:
+            e = errors.get(instance_endpoint(model_name, uuid))
+        if e is None:
+            OutboxEntry.objects.filter(
+                pk__in=[entry.pk for entry in group]
+            ).delete()
+            done += 1
+            continue
+
+        sys.stderr.write('%s %s %s\n%s\n%s\n' % (
+            group[-1].action, model_name, uuid, type(e).__name__, e))
+        entry = group[-1]
+        entry.attempts += 1
+        entry.last_error = '%s: %s' % (type(e).__name__, e)
+        entry.save()
+        failed += 1
+
+    return done, failed
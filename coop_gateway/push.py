@@ -0,0 +1,566 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from coop_local.models import Engagement
+
+from coop_gateway import (
+    client,
+    report,
+)
+from coop_gateway.models import PushedPayload
+from coop_gateway.serializers import (
+    serialize_calendar,
+    serialize_calendars,
+    serialize_event,
+    serialize_events,
+    serialize_exchange,
+    serialize_exchanges,
+    serialize_location,
+    serialize_locations,
+    serialize_organization,
+    serialize_organizations,
+    serialize_person,
+    serialize_persons,
+    serialize_product,
+    serialize_products,
+)
+
+
+# Models in the order the PES needs them: an object only refers to objects
+# of the models listed before its own.
+ORDER = (
+    'Location',
+    'Person',
+    'Organization',
+    'Calendar',
+    'Event',
+    'Product',
+    'Exchange',
+)
+
+ENDPOINTS = {
+    'Location': 'locations',
+    'Person': 'persons',
+    'Organization': 'organizations',
+    'Calendar': 'calendars',
+    'Event': 'events',
+    'Product': 'products',
+    'Exchange': 'exchanges',
+}
+
+SERIALIZERS = {
+    'Location': serialize_location,
+    'Person': serialize_person,
+    'Organization': serialize_organization,
+    'Calendar': serialize_calendar,
+    'Event': serialize_event,
+    'Product': serialize_product,
+    'Exchange': serialize_exchange,
+}
+
+BATCH_SERIALIZERS = {
+    'Location': serialize_locations,
+    'Person': serialize_persons,
+    'Organization': serialize_organizations,
+    'Calendar': serialize_calendars,
+    'Event': serialize_events,
+    'Product': serialize_products,
+    'Exchange': serialize_exchanges,
+}
+
+
+def endpoint_url(endpoint):
+    url = os.path.join(settings.PES_HOST, 'api', endpoint)
+    return '%s?api_key=%s' % (url, settings.PES_API_KEY)
+
+
+def push_data(endpoint, data):
+    report.log('PUT %s' % endpoint_url(endpoint))
+    response = client.put(endpoint_url(endpoint), data=json.dumps(data))
+    response.raise_for_status()
+
+
+def delete_data(endpoint):
+    response = client.delete(endpoint_url(endpoint))
+    if response.status_code != 404:
+        response.raise_for_status()
+
+
+def payload_digest(data):
+    encoded = json.dumps(data, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def pushed_digests(endpoints):
+    digests = {}
+    for chunk in chunks(endpoints, 500):
+        digests.update(PushedPayload.objects.filter(
+            endpoint__in=chunk
+        ).values_list('endpoint', 'digest'))
+    return digests
+
+
+def remember_digests(digests):
+    for chunk in chunks(list(digests.keys()), 500):
+        PushedPayload.objects.filter(endpoint__in=chunk).delete()
+        PushedPayload.objects.bulk_create([
+            PushedPayload(endpoint=endpoint, digest=digests[endpoint])
+            for endpoint in chunk
+        ])
+
+
+def forget_digests(endpoints):
+    for chunk in chunks(endpoints, 500):
+        PushedPayload.objects.filter(endpoint__in=chunk).delete()
+
+
+def instance_endpoint(model_name, uuid):
+    return '%s/%s/' % (ENDPOINTS[model_name], uuid)
+
+
+def bulk_endpoint(model_name):
+    return '%s/bulk/' % ENDPOINTS[model_name]
+
+
+class BulkUnsupported(Exception):
+    pass
+
+
+class BulkItemError(Exception):
+    pass
+
+
+def bulk_errors(model_name, response):
+    """Returns the errors of the items the PES rejected, by endpoint.
+
+    The PES answers a bulk request with one result per item, like
+    ``{"uuid": "...", "status": 400, "error": "..."}``.
+    """
+    errors = {}
+    for result in response.json():
+        status = result.get('status', 200)
+        if status >= 400:
+            endpoint = instance_endpoint(model_name, result['uuid'])
+            errors[endpoint] = BulkItemError('%s %s' % (
+                status, result.get('error', '')))
+    return errors
+
+
+def bulk_request(method, model_name, data):
+    endpoint = bulk_endpoint(model_name)
+    report.log('%s %s (%s items)' % (method, endpoint_url(endpoint),
+                                     len(data)))
+    response = client.request(method, endpoint_url(endpoint),
+                              data=json.dumps(data))
+    if response.status_code in (404, 405, 501):
+        raise BulkUnsupported(endpoint)
+    response.raise_for_status()
+    return bulk_errors(model_name, response)
+
+
+def push_bulk(model_name, payloads):
+    return bulk_request('PUT', model_name, payloads)
+
+
+def delete_bulk(model_name, uuids):
+    return bulk_request('DELETE', model_name, uuids)
+
+
+def no_dependencies(instances):
+    return []
+
+
+def reloaded(instances):
+    """Returns a queryset of the instances, all of the same model."""
+    model = instances[0]._meta.concrete_model
+    return model.objects.filter(pk__in=[
+        instance.pk
+        for instance in instances
+    ])
+
+
+def serialize_all(name, instances, errors):
+    """Returns the (instance, payload) of the instances of the model name,
+    serializing them together when possible.
+
+    The instances failing to serialize are left out, their errors are set
+    in errors by endpoint.
+    """
+    serialized = {}
+    for chunk in chunks(instances, 500):
+        try:
+            serialized.update(
+                (data['uuid'], data)
+                for data in BATCH_SERIALIZERS[name](reloaded(chunk))
+            )
+        except Exception:
+            # Serialized one by one below to find the failing ones
+            pass
+
+    payloads = []
+    for instance in instances:
+        data = serialized.get(instance.uuid)
+        if data is None:
+            try:
+                data = SERIALIZERS[name](instance)
+            except Exception as e:
+                errors[instance_endpoint(name, instance.uuid)] = e
+                continue
+        payloads.append((instance, data))
+    return payloads
+
+
+def organization_dependencies(organizations):
+    engagements = Engagement.objects.filter(organization__in=[
+        organization.pk
+        for organization in organizations
+    ])
+    return [
+        engagement.person
+        for engagement in engagements.select_related('person')
+    ]
+
+
+def event_dependencies(events):
+    dependencies = []
+    for event in reloaded(events).select_related(
+            'calendar', 'organization'
+    ).prefetch_related('organizations'):
+        dependencies.append(event.calendar)
+        if event.organization:
+            dependencies.append(event.organization)
+        dependencies.extend(event.organizations.all())
+    return dependencies
+
+
+def exchange_dependencies(exchanges):
+    dependencies = []
+    for exchange in reloaded(exchanges).select_related(
+            'organization', 'person'
+    ).prefetch_related('products'):
+        if exchange.organization:
+            dependencies.append(exchange.organization)
+        if exchange.person:
+            dependencies.append(exchange.person)
+        dependencies.extend(exchange.products.all())
+    return dependencies
+
+
+DEPENDENCIES = {
+    'Organization': organization_dependencies,
+    'Event': event_dependencies,
+    'Exchange': exchange_dependencies,
+}
+
+
+class PushBatch(object):
+    """Collects objects to send to the PES.
+
+    Each object is sent at most once for the lifetime of the batch, after
+    the objects it refers to. Objects whose payload did not change since
+    they were last sent are skipped unless ``force`` is set.
+
+    With a ``bulk_size``, objects of a model are sent by groups of that
+    size to the bulk endpoint of the model, or one by one when the PES
+    does not provide it.
+
+    With several ``workers``, the requests for the objects of a model are
+    sent concurrently. A model is only sent once all the objects of the
+    models it depends on are. Only the HTTP requests run in the workers,
+    the database is used from the calling thread.
+    """
+
+    def __init__(self, force=False, bulk_size=None, workers=1):
+        self.force = force
+        self.bulk_size = bulk_size
+        self.workers = workers
+        self.pool = None
+        self.bulk_unsupported = set()
+        self.seen = set()
+        # Objects whose dependencies are being added, against cycles
+        self.adding = set()
+        self.pending = dict((name, []) for name in ORDER)
+        self.deleted = []
+        # Errors of the objects that could not be added, by endpoint
+        self.errors = {}
+
+    def add(self, instance):
+        self.add_all([instance])
+
+    def add_all(self, instances):
+        """Adds objects of a model, looking up the objects they refer to
+        together.
+
+        When that fails, the objects are added one by one, the errors of the
+        failing ones are returned by the next flush.
+        """
+        try:
+            self._add_all(instances)
+            return
+        except Exception as e:
+            if len(instances) == 1:
+                name = instances[0]._meta.object_name
+                self.errors[instance_endpoint(name, instances[0].uuid)] = e
+                report.count(name, 'failed')
+                return
+
+        for instance in instances:
+            self.add_all([instance])
+
+    def _add_all(self, instances):
+        added = OrderedDict()
+        for instance in instances:
+            endpoint = instance_endpoint(instance._meta.object_name,
+                                         instance.uuid)
+            if endpoint not in self.seen and endpoint not in self.adding:
+                added.setdefault(endpoint, instance)
+        if not added:
+            return
+
+        instances = list(added.values())
+        name = instances[0]._meta.object_name
+        self.adding.update(added)
+        try:
+            dependencies = DEPENDENCIES.get(name, no_dependencies)(
+                instances)
+
+            #Ensure the objects they refer to exist on the pes
+            by_model = OrderedDict()
+            for dependency in dependencies:
+                by_model.setdefault(dependency._meta.object_name,
+                                    []).append(dependency)
+            for dependencies in by_model.values():
+                self._add_all(dependencies)
+        finally:
+            self.adding.difference_update(added)
+
+        # Only objects reaching pending are seen, failed ones can be added
+        # again
+        self.seen.update(added)
+        self.pending[name].extend(instances)
+
+    def delete(self, model_name, uuid):
+        endpoint = instance_endpoint(model_name, uuid)
+        self.seen.add(endpoint)
+        self.pending[model_name] = [
+            instance
+            for instance in self.pending[model_name]
+            if instance.uuid != uuid
+        ]
+        self.deleted.append((model_name, uuid))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _map(self, function, items):
+        """Calls function on each item, returns the merged results."""
+        if self.workers > 1 and len(items) > 1:
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+            results = self.pool.map(function, items)
+        else:
+            results = [function(item) for item in items]
+
+        done, errors = {}, {}
+        for item_done, item_errors in results:
+            done.update(item_done)
+            errors.update(item_errors)
+        return done, errors
+
+    def _payloads(self, name, instances, errors):
+        """Returns the payloads that changed since they were last sent."""
+        endpoints = [
+            instance_endpoint(name, instance.uuid)
+            for instance in instances
+        ]
+        digests = {} if self.force else pushed_digests(endpoints)
+
+        payloads = []
+        for instance, data in serialize_all(name, instances, errors):
+            endpoint = instance_endpoint(name, instance.uuid)
+            digest = payload_digest(data)
+            if digests.get(endpoint) != digest:
+                payloads.append((endpoint, data, digest))
+
+        return payloads
+
+    def _push_one(self, payload):
+        endpoint, data, digest = payload
+        try:
+            push_data(endpoint, data)
+        except Exception as e:
+            return {}, {endpoint: e}
+        return {endpoint: digest}, {}
+
+    def _push_each(self, payloads):
+        done, errors = {}, {}
+        for payload in payloads:
+            payload_done, payload_errors = self._push_one(payload)
+            done.update(payload_done)
+            errors.update(payload_errors)
+        return done, errors
+
+    def _push_chunk(self, chunk):
+        name, payloads = chunk
+        if name in self.bulk_unsupported:
+            return self._push_each(payloads)
+
+        try:
+            errors = push_bulk(name, [data for _, data, _ in payloads])
+        except BulkUnsupported:
+            self.bulk_unsupported.add(name)
+            return self._push_each(payloads)
+        except Exception as e:
+            return {}, dict((endpoint, e) for endpoint, _, _ in payloads)
+
+        return dict(
+            (endpoint, digest)
+            for endpoint, _, digest in payloads
+            if endpoint not in errors
+        ), errors
+
+    def _delete_one(self, endpoint):
+        try:
+            delete_data(endpoint)
+        except Exception as e:
+            return {}, {endpoint: e}
+        return {endpoint: None}, {}
+
+    def _delete_each(self, name, uuids):
+        done, errors = {}, {}
+        for uuid in uuids:
+            uuid_done, uuid_errors = self._delete_one(
+                instance_endpoint(name, uuid))
+            done.update(uuid_done)
+            errors.update(uuid_errors)
+        return done, errors
+
+    def _delete_chunk(self, chunk):
+        name, uuids = chunk
+        if name in self.bulk_unsupported:
+            return self._delete_each(name, uuids)
+
+        try:
+            errors = delete_bulk(name, uuids)
+        except BulkUnsupported:
+            self.bulk_unsupported.add(name)
+            return self._delete_each(name, uuids)
+        except Exception as e:
+            return {}, dict(
+                (instance_endpoint(name, uuid), e)
+                for uuid in uuids
+            )
+
+        return dict(
+            (endpoint, None)
+            for endpoint in [instance_endpoint(name, uuid) for uuid in uuids]
+            if endpoint not in errors
+        ), errors
+
+    def _push(self, name, payloads):
+        if self.bulk_size:
+            return self._map(self._push_chunk, [
+                (name, chunk)
+                for chunk in chunks(payloads, self.bulk_size)
+            ])
+        return self._map(self._push_one, payloads)
+
+    def _delete(self, name, uuids):
+        if self.bulk_size:
+            return self._map(self._delete_chunk, [
+                (name, chunk)
+                for chunk in chunks(uuids, self.bulk_size)
+            ])
+        return self._map(self._delete_one, [
+            instance_endpoint(name, uuid)
+            for uuid in uuids
+        ])
+
+    def send(self, name, records):
+        """Sends records already serialized for the model name, returns the
+        errors by endpoint.
+
+        Unlike added objects, the records are sent at once and the objects
+        they refer to are not sent before them.
+        """
+        endpoints = [
+            instance_endpoint(name, data['uuid'])
+            for data in records
+        ]
+        with report.phase('serialize'):
+            digests = {} if self.force else pushed_digests(endpoints)
+
+            payloads = []
+            for endpoint, data in zip(endpoints, records):
+                digest = payload_digest(data)
+                if digests.get(endpoint) != digest:
+                    payloads.append((endpoint, data, digest))
+
+        with report.phase('push'):
+            done, errors = self._push(name, payloads)
+        with report.phase('save'):
+            remember_digests(done)
+
+        report.count(name, 'pushed', len(done))
+        report.count(name, 'unchanged', len(records) - len(payloads))
+        report.count(name, 'failed', len(errors))
+        return errors
+
+    def flush(self):
+        """Sends the pending objects, returns the errors by endpoint."""
+        errors, self.errors = self.errors, {}
+
+        for name in ORDER:
+            instances, self.pending[name] = self.pending[name], []
+            if not instances:
+                continue
+
+            failed = len(errors)
+            with report.phase('serialize'):
+                payloads = self._payloads(name, instances, errors)
+            failed = len(errors) - failed
+
+            with report.phase('push'):
+                done, push_errors = self._push(name, payloads)
+            with report.phase('save'):
+                remember_digests(done)
+            errors.update(push_errors)
+
+            report.count(name, 'pushed', len(done))
+            report.count(name, 'unchanged',
+                         len(instances) - len(payloads) - failed)
+            report.count(name, 'failed', failed + len(push_errors))
+
+        # Objects referring to others are deleted first
+        deleted, self.deleted = self.deleted, []
+        for name in reversed(ORDER):
+            uuids = [
+                uuid
+                for model_name, uuid in deleted
+                if model_name == name
+            ]
+            if not uuids:
+                continue
+
+            with report.phase('push'):
+                done, delete_errors = self._delete(name, uuids)
+            with report.phase('save'):
+                forget_digests(list(done.keys()))
+            errors.update(delete_errors)
+
+            report.count(name, 'deleted', len(done))
+            report.count(name, 'failed', len(delete_errors))
+
+        return errors
@@ -0,0 +1,68 @@
+def no_changes(instance, data):
+    return {}
+
+
+def reconcile(model, existing, incoming, existing_key, incoming_key, build,
+              changes=no_changes, bulk=False):
+    """Makes the existing child rows match the incoming child records.
+
+    Rows and records are matched by natural key. Rows without a record are
+    deleted together, and matched rows are only written when ``changes``
+    returns the fields of the row that differ from the record. Unchanged
+    children cost no write.
+
+    Rows are saved one by one, unless ``bulk`` is set: records without a
+    row are then inserted together and changed rows updated without their
+    save method.
+
+    Returns the number of rows created, updated and deleted.
+    """
+    rows = {}
+    stale = []
+    for instance in existing:
+        key = existing_key(instance)
+        if key in rows:
+            stale.append(instance.pk)
+        else:
+            rows[key] = instance
+
+    created = []
+    updated = 0
+    seen = set()
+    for data in incoming:
+        key = incoming_key(data)
+        if key in seen:
+            continue
+        seen.add(key)
+
+        instance = rows.get(key)
+        if instance is None:
+            created.append(build(data))
+            continue
+
+        fields = changes(instance, data)
+        if not fields:
+            continue
+        if bulk:
+            model.objects.filter(pk=instance.pk).update(**fields)
+        else:
+            for name, value in fields.items():
+                setattr(instance, name, value)
+            instance.save()
+        updated += 1
+
+    stale.extend(
+        instance.pk
+        for key, instance in rows.items()
+        if key not in seen
+    )
+
+    if stale:
+        model.objects.filter(pk__in=stale).delete()
+    if bulk and created:
+        model.objects.bulk_create(created)
+    elif created:
+        for instance in created:
+            instance.save()
+
+    return len(created), updated, len(stale)
@@ -0,0 +1,163 @@
+import os
+import sys
+import threading
+from time import (
+    sleep,
+    time,
+)
+
+from django.conf import settings
+from django.core.cache import cache
+
+from coop_gateway import (
+    client,
+    report,
+)
+from coop_gateway.dump import (
+    dump_path,
+    read_dump,
+)
+
+
+class ReferenceData(object):
+    """Reference data of the PES, with lookup indexes built once.
+
+    The data is shared between processes through the Django cache. Once
+    older than ``PES_REFERENCE_TTL`` seconds it is still served, for up to
+    ``PES_REFERENCE_STALE_TTL`` more seconds, while a single thread of a
+    single process refreshes it.
+    """
+
+    def __init__(self, name, endpoint, build_indexes):
+        self.name = name
+        self.endpoint = endpoint
+        self.build_indexes = build_indexes
+        self.key = 'coop_gateway:reference:%s' % name
+        self.lock_key = '%s:lock' % self.key
+        self.lock = threading.Lock()
+        self.local = None
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'PES_REFERENCE_TTL', 120)
+
+    @property
+    def stale_ttl(self):
+        return getattr(settings, 'PES_REFERENCE_STALE_TTL', 24 * 3600)
+
+    def url(self):
+        return os.path.join(settings.PES_HOST, 'api', self.endpoint)
+
+    def fetch(self):
+        url = self.url()
+        report.log('GET %s' % url)
+
+        response = client.get(url)
+        response.raise_for_status()
+        return {
+            'expires': time() + self.ttl,
+            'indexes': self.build_indexes(response.json()),
+        }
+
+    def use_dump(self, directory):
+        """Serves the data of the dump of directory instead of the PES for
+        the rest of the process, when there is one."""
+        path = dump_path(directory, self.name)
+        if not os.path.exists(path):
+            report.log('No dump %s' % path, 1)
+            return
+
+        report.log('READ %s' % path)
+        self.local = {
+            'expires': float('inf'),
+            'indexes': self.build_indexes(list(read_dump(path))),
+        }
+
+    def refresh(self):
+        """Fetches and shares the data, unless another process already
+        does."""
+        if not cache.add(self.lock_key, True, 60):
+            return None
+        try:
+            value = self.fetch()
+            cache.set(self.key, value, self.ttl + self.stale_ttl)
+            self.local = value
+            return value
+        finally:
+            cache.delete(self.lock_key)
+
+    def refresh_in_background(self):
+        if not self.lock.acquire(False):
+            return
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                sys.stderr.write('%s\n%s\n' % (type(e).__name__, e))
+            finally:
+                self.lock.release()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def wait_for_refresh(self, timeout=10):
+        deadline = time() + timeout
+        while time() < deadline:
+            sleep(0.1)
+            value = cache.get(self.key)
+            if value is not None:
+                return value
+        return None
+
+    def load(self):
+        with self.lock:
+            value = cache.get(self.key)
+            if value is None:
+                value = self.refresh() or self.wait_for_refresh()
+            if value is None:
+                # The process refreshing it is stuck or gone
+                value = self.fetch()
+                cache.set(self.key, value, self.ttl + self.stale_ttl)
+            self.local = value
+            return value
+
+    def get(self):
+        value = self.local
+        if value is None or value['expires'] < time():
+            value = cache.get(self.key)
+            if value is None:
+                value = self.load()
+            self.local = value
+
+        if value['expires'] < time():
+            self.refresh_in_background()
+
+        return value['indexes']
+
+
+def roles_indexes(roles):
+    return {
+        'by_slug': dict((role['slug'], role['uuid']) for role in roles),
+        'by_uuid': dict((role['uuid'], role['slug']) for role in roles),
+    }
+
+
+def legal_statuses_indexes(legal_statuses):
+    return {
+        'all': legal_statuses,
+        'by_label': dict(
+            (status['label'], status['slug'])
+            for status in legal_statuses
+        ),
+        'by_slug': dict(
+            (status['slug'], status['label'])
+            for status in legal_statuses
+        ),
+    }
+
+
+roles = ReferenceData('roles', 'roles/', roles_indexes)
+legal_statuses = ReferenceData('legal_statuses', 'legal_statuses/',
+                               legal_statuses_indexes)
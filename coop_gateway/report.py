@@ -0,0 +1,269 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+from django.conf import settings
+
+
+_active = None
+_verbosity = 1
+
+
+def http_key(method, url):
+    """Returns the key of a request in the report, like GET organizations."""
+    parts = [part for part in urlparse(url).path.split('/') if part]
+    if 'api' in parts:
+        parts = parts[parts.index('api') + 1:]
+    name = parts[0] if parts else url
+    if parts[1:2] == ['bulk']:
+        name += '/bulk'
+    return '%s %s' % (method, name)
+
+
+class Report(object):
+    """Timings and counters of a run of a command.
+
+    The time of the thread using the database is split in phases. A phase
+    entered within another one is not counted in it, and the queries are
+    counted in the phase they are sent from. The requests to the PES are
+    counted by method and endpoint, from any thread.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.seconds = None
+        self.phases = {}
+        self.http = {}
+        self.records = {}
+
+    def _add(self, table, key, **values):
+        with self.lock:
+            entry = table.setdefault(key, {})
+            for name, value in values.items():
+                entry[name] = entry.get(name, 0) + value
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    @contextmanager
+    def phase(self, name):
+        stack = self._stack()
+        now = time.time()
+        if stack:
+            self._add(self.phases, stack[-1][0], seconds=now - stack[-1][1])
+        stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.time()
+            name, since = stack.pop()
+            self._add(self.phases, name, seconds=now - since)
+            if stack:
+                stack[-1][1] = now
+
+    def query(self, seconds):
+        stack = self._stack()
+        name = stack[-1][0] if stack else 'other'
+        self._add(self.phases, name, queries=1, query_seconds=seconds)
+
+    def count(self, model_name, name, number=1):
+        if number:
+            self._add(self.records, model_name, **{name: number})
+
+    def request(self, method, url, seconds, sent, received):
+        self._add(self.http, http_key(method, url), requests=1,
+                  seconds=seconds, bytes_sent=sent, bytes_received=received)
+
+    def stream(self, method, url, chunks):
+        """Yields the chunks of a response body, counting their download."""
+        key = http_key(method, url)
+        chunks = iter(chunks)
+        while True:
+            start = time.time()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            self._add(self.http, key, seconds=time.time() - start,
+                      bytes_received=len(chunk))
+            yield chunk
+
+    def finish(self):
+        self.seconds = time.time() - self.started
+
+    def as_dict(self):
+        with self.lock:
+            phases = dict(
+                (name, dict(values))
+                for name, values in self.phases.items()
+            )
+            seconds = self.seconds or time.time() - self.started
+            other = phases.setdefault('other', {})
+            other['seconds'] = max(seconds - sum(
+                values.get('seconds', 0)
+                for name, values in phases.items()
+                if name != 'other'
+            ), 0)
+            return {
+                'command': self.command,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                         time.localtime(self.started)),
+                'seconds': seconds,
+                'phases': phases,
+                'http': dict(
+                    (key, dict(values))
+                    for key, values in self.http.items()
+                ),
+                'records': dict(
+                    (name, dict(values))
+                    for name, values in self.records.items()
+                ),
+            }
+
+    def summary(self):
+        lines = []
+        for model_name, counts in sorted(self.records.items()):
+            lines.append('%s: %s' % (model_name, ', '.join(
+                '%s %s' % (counts[name], name)
+                for name in sorted(counts)
+            )))
+        lines.append('Done in %.1f s' % (self.seconds or
+                                         time.time() - self.started))
+        return '\n'.join(lines)
+
+    def write(self, path):
+        """Writes the report as JSON to path, - for the standard output."""
+        data = json.dumps(self.as_dict(), indent=2, sort_keys=True)
+        if path == '-':
+            sys.stdout.write(data + '\n')
+            return
+        with open(path, 'w') as f:
+            f.write(data + '\n')
+
+
+def count_queries(report):
+    """Times the queries of the connections of the current thread in the
+    report, returns a function undoing it."""
+    from django.db import connections
+    from django.db.backends.util import CursorWrapper
+
+    class TimedCursor(CursorWrapper):
+
+        def execute(self, *args):
+            self.set_dirty()
+            start = time.time()
+            try:
+                return self.cursor.execute(*args)
+            finally:
+                report.query(time.time() - start)
+
+        def executemany(self, *args):
+            self.set_dirty()
+            start = time.time()
+            try:
+                return self.cursor.executemany(*args)
+            finally:
+                report.query(time.time() - start)
+
+    previous = []
+    for connection in connections.all():
+        use_debug_cursor = connection.use_debug_cursor
+        debug = use_debug_cursor or (use_debug_cursor is None
+                                     and settings.DEBUG)
+
+        def make_cursor(cursor, connection=connection, debug=debug,
+                        make_debug_cursor=connection.make_debug_cursor):
+            # Queries are still logged when DEBUG is set
+            if debug:
+                cursor = make_debug_cursor(cursor)
+            return TimedCursor(cursor, connection)
+
+        # A wrapper installed on the connection before is put back
+        patched = connection.__dict__.get('make_debug_cursor')
+        connection.make_debug_cursor = make_cursor
+        connection.use_debug_cursor = True
+        previous.append((connection, use_debug_cursor, patched))
+
+    def restore():
+        for connection, use_debug_cursor, patched in previous:
+            if patched is None:
+                del connection.make_debug_cursor
+            else:
+                connection.make_debug_cursor = patched
+            connection.use_debug_cursor = use_debug_cursor
+    return restore
+
+
+@contextmanager
+def reporting(report, verbosity=1):
+    """Makes report the report of the block, and verbosity its level of
+    output."""
+    global _active, _verbosity
+    previous = _active, _verbosity
+    _active, _verbosity = report, verbosity
+    restore = count_queries(report)
+    try:
+        yield report
+    finally:
+        restore()
+        report.finish()
+        _active, _verbosity = previous
+
+
+@contextmanager
+def phase(name):
+    report = _active
+    if report is None:
+        yield
+    else:
+        with report.phase(name):
+            yield
+
+
+def timed(name, iterable):
+    """Yields the items of iterable, counting the time taken to get each one
+    in the phase name."""
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def count(model_name, name, number=1):
+    if _active is not None:
+        _active.count(model_name, name, number)
+
+
+def request(method, url, seconds, sent, received):
+    if _active is not None:
+        _active.request(method, url, seconds, sent, received)
+
+
+def stream(method, url, chunks):
+    if _active is None:
+        return chunks
+    return _active.stream(method, url, chunks)
+
+
+def log(message, level=2):
+    """Writes a progress message when the verbosity allows it, per record
+    messages are only written from level 2."""
+    if _verbosity >= level:
+        sys.stdout.write(message + '\n')
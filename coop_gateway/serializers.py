@@ -1,16 +1,16 @@
 # encoding: utf-8
 
-import json
-import os
-import sys
-from time import time
+import datetime
+import decimal
 
 import dateutil
-import requests
 import shortuuid
 
-from django.conf import settings
-from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import (
+    is_protected_type,
+    smart_unicode,
+)
 
 from coop.exchange.models import (
     EWAY,
@@ -25,6 +25,8 @@ from coop_local.models import (
 )
 from coop_local.models.local_models import STATUTS
 
+from coop_gateway import reference
+
 organization_default_fields = [
     'uuid',
     'title',
@@ -51,81 +53,113 @@ person_default_fields = [
 ]
 
 
-def serialize(obj, include):
-    fields = json.loads(serializers.serialize('json', [obj]))[0]['fields']
-    result = {
-        'uuid': fields['uuid']
-    }
+_json_encoder = DjangoJSONEncoder()
 
-    for name in include:
-        if name in fields:
-            result[name] = fields[name]
 
-    return result
+def json_value(value):
+    if isinstance(value, (datetime.date, datetime.time, decimal.Decimal)):
+        return _json_encoder.default(value)
+    return value
 
 
-_roles = []
-_roles_last_update = time()
+def field_getter(field):
+    if field.rel is not None:
+        attname = field.get_attname()
+        return lambda obj: json_value(getattr(obj, attname))
 
+    def get(obj):
+        value = field._get_val_from_obj(obj)
+        if is_protected_type(value):
+            return json_value(value)
+        return field.value_to_string(obj)
+    return get
 
-def get_pes_roles_by_slug():
-    global _roles, _roles_last_update
 
-    if (time() - _roles_last_update) > 120:
-        url = os.path.join(settings.PES_HOST, 'api/roles/')
-        sys.stdout.write('GET %s ' % url)
+def many_to_many_getter(field):
+    def get(obj):
+        return [
+            smart_unicode(related._get_pk_val())
+            for related in getattr(obj, field.name).all()
+        ]
+    return get
 
-        response = requests.get(url)
-        response.raise_for_status()
-        _roles = dict([
-            (role['slug'], role['uuid'])
-            for role in response.json()
-        ])
-        _roles_last_update = time()
 
-    return _roles
+def compile_plan(model, include):
+    """Returns the (name, getter) pairs serializing the fields of include
+    the way the Django JSON serializer does."""
+    opts = model._meta.concrete_model._meta
+    getters = {}
 
+    for field in opts.local_fields:
+        if field.serialize:
+            getters[field.name] = field_getter(field)
 
-_legal_statuses = []
-_legal_statuses_last_update = time()
+    for field in opts.local_many_to_many:
+        if field.serialize and field.rel.through._meta.auto_created:
+            getters[field.name] = many_to_many_getter(field)
 
+    return [('uuid', getters['uuid'])] + [
+        (name, getters[name])
+        for name in include
+        if name in getters
+    ]
+
+
+_plans = {}
+
+
+def serialization_plan(model, include):
+    key = (model, tuple(include))
+    plan = _plans.get(key)
+    if plan is None:
+        plan = _plans[key] = compile_plan(model, include)
+    return plan
+
+
+def serialize(obj, include):
+    return dict(
+        (name, get(obj))
+        for name, get in serialization_plan(type(obj), include)
+    )
 
-def get_pes_legal_statuses():
-    global _legal_statuses, _legal_statuses_last_update
 
-    if (time() - _legal_statuses_last_update) > 120:
-        url = os.path.join(settings.PES_HOST, 'api/legal_statuses/')
-        sys.stdout.write('GET %s\n' % url)
+def get_pes_roles_by_slug():
+    return reference.roles.get()['by_slug']
 
-        response = requests.get(url)
-        response.raise_for_status()
-        _legal_statuses = response.json()
-        _legal_statuses_last_update = time()
 
-    return _legal_statuses
+def get_pes_legal_statuses():
+    return reference.legal_statuses.get()['all']
 
 
 def get_pes_legal_statuses_by_label():
-    return dict([
-        (role['label'], role['slug'])
-        for role in get_pes_legal_statuses()
-    ])
+    return reference.legal_statuses.get()['by_label']
 
 
 def get_pes_legal_statuses_by_slug():
-    return dict([
-        (role['slug'], role['label'])
-        for role in get_pes_legal_statuses()
-    ])
+    return reference.legal_statuses.get()['by_slug']
+
+
+_local_roles_by_uuid = None
+
+
+def get_local_roles_by_uuid():
+    global _local_roles_by_uuid
+
+    roles = _local_roles_by_uuid
+    if roles is None:
+        roles = _local_roles_by_uuid = dict(
+            Role.objects.values_list('uuid', 'slug'))
+    return roles
+
+
+def local_roles_changed(sender, **kwargs):
+    global _local_roles_by_uuid
+    _local_roles_by_uuid = None
 
 
 def translate_role_uuid(role_uuid):
     pes_roles_by_slug = get_pes_roles_by_slug()
-    local_roles_by_uuid = dict([
-        (role.uuid, role.slug)
-        for role in Role.objects.all()
-    ])
-    local_role = local_roles_by_uuid.get(role_uuid, None)
+    local_role = get_local_roles_by_uuid().get(role_uuid, None)
     return pes_roles_by_slug.get(local_role, None)
 
 
@@ -161,25 +195,30 @@ def serialize_location(location):
     return result
 
 
-def serialize_members(queryset):
+def serialize_members(engagements):
     return [
         {
             'person': engagement.person.uuid,
-            'role': translate_role_uuid(engagement.role.uuid),
+            'role': translate_role_uuid(getattr(engagement.role, 'uuid',
+                                                None)),
             'role_detail': engagement.role_detail,
         }
-        for engagement in queryset.all()
+        for engagement in engagements
     ]
 
 
-def serialize_organization(organization, include=organization_default_fields):
+def serialize_organization(organization, include=organization_default_fields,
+                           engagements=None):
     result = serialize(organization, include)
 
     if 'contacts' in include:
         result['contacts'] = serialize_contacts(organization.contacts)
 
     if 'members' in include:
-        engagements = Engagement.objects.filter(organization=organization)
+        if engagements is None:
+            engagements = Engagement.objects.filter(
+                organization=organization
+            ).select_related('person', 'role')
         result['members'] = serialize_members(engagements)
 
     if 'pref_phone' in include and organization.pref_phone:
@@ -262,6 +301,74 @@ def serialize_exchange(exchange):
     return result
 
 
+def engagements_by_organization(organizations):
+    engagements = dict((organization.pk, []) for organization in organizations)
+    queryset = Engagement.objects.filter(
+        organization__in=list(engagements.keys())
+    ).select_related('person', 'role')
+    for engagement in queryset:
+        engagements[engagement.organization_id].append(engagement)
+    return engagements
+
+
+def serialize_organizations(queryset, include=organization_default_fields):
+    organizations = list(queryset.select_related(
+        'pref_phone', 'pref_email'
+    ).prefetch_related('contacts'))
+
+    engagements = {}
+    if 'members' in include:
+        engagements = engagements_by_organization(organizations)
+
+    return [
+        serialize_organization(organization, include,
+                               engagements.get(organization.pk))
+        for organization in organizations
+    ]
+
+
+def serialize_persons(queryset, include=person_default_fields):
+    return [
+        serialize_person(person, include)
+        for person in queryset.select_related(
+            'pref_email'
+        ).prefetch_related('contacts')
+    ]
+
+
+def serialize_locations(queryset):
+    return [serialize_location(location) for location in queryset]
+
+
+def serialize_calendars(queryset):
+    return [serialize_calendar(calendar) for calendar in queryset]
+
+
+def serialize_events(queryset):
+    return [
+        serialize_event(event)
+        for event in queryset.select_related(
+            'calendar', 'organization'
+        ).prefetch_related('organizations', 'occurrence_set')
+    ]
+
+
+def serialize_products(queryset):
+    return [
+        serialize_product(product)
+        for product in queryset.select_related('organization')
+    ]
+
+
+def serialize_exchanges(queryset):
+    return [
+        serialize_exchange(exchange)
+        for exchange in queryset.select_related(
+            'person'
+        ).prefetch_related('products', 'methods')
+    ]
+
+
 def setattr_from(obj, attr, data, default=None, parse=lambda x: x):
     if attr in data:
         value = parse(data[attr])
@@ -284,14 +391,16 @@ def get_legal_status(slug):
         return 0
 
 
-def get_contact(uuid):
+def get_contact(uuid, identities=None):
+    if identities is not None:
+        return identities.get(Contact, uuid)
     try:
         return Contact.objects.get(uuid=uuid)
     except Exception:
         return None
 
 
-def deserialize_location(location, data):
+def deserialize_location(location, data, identities=None):
     location.uuid = data['uuid']
     location.title = data['label']
 
@@ -302,7 +411,10 @@ def deserialize_location(location, data):
     setattr_from(location, 'country', data)
 
 
-def deserialize_organization(organization, data):
+def deserialize_organization(organization, data, identities=None):
+    def contact(uuid):
+        return get_contact(uuid, identities)
+
     organization.uuid = data['uuid']
     organization.title = data['title']
 
@@ -310,8 +422,8 @@ def deserialize_organization(organization, data):
     setattr_from(organization, 'acronym', data)
     setattr_from(organization, 'annual_revenue', data)
     setattr_from(organization, 'birth', data, parse=parse_date)
-    setattr_from(organization, 'pref_email', data, parse=get_contact)
-    setattr_from(organization, 'pref_phone', data, parse=get_contact)
+    setattr_from(organization, 'pref_email', data, parse=contact)
+    setattr_from(organization, 'pref_phone', data, parse=contact)
     setattr_from(organization, 'testimony', data, '')
     setattr_from(organization, 'web', data)
     setattr_from(organization, 'workforce', data)
@@ -319,13 +431,18 @@ def deserialize_organization(organization, data):
     organization.statut = get_legal_status(data.get('legal_status'))
 
 
-def deserialize_person(person, data):
+def deserialize_person(person, data, identities=None):
+    def contact(uuid):
+        return get_contact(uuid, identities)
+
     person.uuid = data['uuid']
     person.first_name = data['first_name']
     person.last_name = data['last_name']
-    setattr_from(person, 'pref_email', data, parse=get_contact)
+    setattr_from(person, 'pref_email', data, parse=contact)
 
-    person.username = shortuuid.uuid()
+    # A username is only made up for a new person, an update keeps it
+    if not person.username:
+        person.username = shortuuid.uuid()
 
 
 def deserialize_contact(content_object, contact, data):
@@ -335,45 +452,55 @@ def deserialize_contact(content_object, contact, data):
     contact.content_object = content_object
 
 
-def deserialize_role(role, data):
+def deserialize_role(role, data, identities=None):
     role.uuid = data['uuid']
     role.label = data['label']
 
 
-def get_organization(uuid):
+def get_organization(uuid, identities=None):
+    if identities is not None:
+        return identities.get(Organization, uuid)
     try:
         return Organization.objects.get(uuid=uuid)
     except Exception:
         return None
 
 
-def get_organizations(uuids):
+def get_organizations(uuids, identities=None):
+    if identities is not None:
+        return identities.get_many(Organization, uuids)
     try:
         return [
             organization
-            for organization in Organization.filter(uuid__in=uuids).all()
+            for organization in Organization.objects.filter(uuid__in=uuids)
         ]
     except Exception:
         return []
 
 
-def deserialize_calendar(calendar, data):
+def deserialize_calendar(calendar, data, identities=None):
     calendar.uuid = data['uuid']
     calendar.title = data['title']
     setattr_from(calendar, 'description', data)
 
 
-def deserialize_event(event, data):
+def deserialize_event(event, data, identities=None):
+    def organization(uuid):
+        return get_organization(uuid, identities)
+
+    def organizations(uuids):
+        return get_organizations(uuids, identities)
+
     event.uuid = data['uuid']
     event.title = data['title']
     setattr_from(event, 'description', data)
     setattr_from(event, 'other_organizations', data)
     setattr_from(event, 'source_info', data)
-    setattr_from(event, 'organization', data, parse=get_organization)
-    setattr_from(event, 'organizations', data, parse=get_organizations)
+    setattr_from(event, 'organization', data, parse=organization)
+    setattr_from(event, 'organizations', data, parse=organizations)
 
 
-def deserialize_exchange(exchange, data):
+def deserialize_exchange(exchange, data, identities=None):
     exchange.uuid = data['uuid']
     exchange.title = data['title']
     exchange.title = data['permanent']
@@ -384,9 +511,12 @@ def deserialize_exchange(exchange, data):
     setattr_from(exchange, 'description', data)
 
 
-def deserialize_product(product, data):
+def deserialize_product(product, data, identities=None):
+    def organization(uuid):
+        return get_organization(uuid, identities)
+
     product.uuid = data['uuid']
     product.first_name = data['title']
 
     setattr_from(product, 'description', data)
-    setattr_from(product, 'organization', data, parse=get_organization)
+    setattr_from(product, 'organization', data, parse=organization)
@@ -1,136 +1,114 @@
-import json
-import os
-import requests
+import threading
+from contextlib import contextmanager
+from functools import wraps
 
-from django.conf import settings
-
-from coop_local.models import (
-    Person,
-    Calendar,
-    Organization,
+from coop_gateway.outbox import (
+    enqueue_delete,
+    enqueue_push,
 )
 
-from coop_gateway.serializers import (
-    serialize_calendar,
-    serialize_event,
-    serialize_exchange,
-    serialize_location,
-    serialize_organization,
-    serialize_person,
-    serialize_product,
-)
 
+_local = threading.local()
 
-def endpoint_url(endpoint):
-    url = os.path.join(settings.PES_HOST, 'api', endpoint)
-    return '%s?api_key=%s' % (url, settings.PES_API_KEY)
 
+@contextmanager
+def sync_suspended():
+    """Stops the receivers from syncing the changes made by the current
+    thread in the block, without disconnecting them."""
+    _local.depth = getattr(_local, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _local.depth -= 1
 
-def push_data(endpoint, data):
-    print('PUT %s' % endpoint_url(endpoint))
-    requests.put(endpoint_url(endpoint), data=json.dumps(data))
 
+def is_sync_suspended():
+    return getattr(_local, 'depth', 0) > 0
 
-def delete_data(endpoint):
-    requests.delete(endpoint_url(endpoint))
 
+def receiver(function):
+    @wraps(function)
+    def wrapper(sender, instance, **kwargs):
+        if not is_sync_suspended():
+            function(sender, instance, **kwargs)
+    return wrapper
 
+
+@receiver
 def contact_saved(sender, instance, **kwargs):
     organization_saved(None, instance.content_object)
 
 
+@receiver
 def contact_deleted(sender, instance, **kwargs):
     organization_saved(None, instance.content_object)
 
 
+@receiver
 def organization_saved(sender, instance, **kwargs):
-    data = serialize_organization(instance)
-
-    #Ensure person exists on the pes
-    for member in data['members']:
-        person = Person.objects.get(uuid=member['person'])
-        person_saved(None, person)
-
-    push_data('organizations/%s/' % instance.uuid, data)
+    enqueue_push(instance)
 
 
+@receiver
 def organization_deleted(sender, instance, **kwargs):
-    delete_data('organizations/%s/' % instance.uuid)
+    enqueue_delete(instance)
 
 
+@receiver
 def person_saved(sender, instance, **kwargs):
-    push_data('persons/%s/' % instance.uuid,
-              serialize_person(instance))
+    enqueue_push(instance)
 
 
+@receiver
 def person_deleted(sender, instance, **kwargs):
-    delete_data('persons/%s/' % instance.uuid)
+    enqueue_delete(instance)
 
 
+@receiver
 def product_saved(sender, instance, **kwargs):
-    push_data('products/%s/' % instance.uuid,
-              serialize_product(instance))
+    enqueue_push(instance)
 
 
+@receiver
 def product_deleted(sender, instance, **kwargs):
-    delete_data('products/%s/' % instance.uuid)
+    enqueue_delete(instance)
 
 
+@receiver
 def exchange_saved(sender, instance, **kwargs):
-
-    #Ensure organization exist on the pes
-    if instance.organization:
-        organization_saved(None, instance.organization)
-
-    #Ensure person exist on the pes
-    if instance.person:
-        person_saved(None, instance.person)
-
-    #Ensure products exist on the pes
-    for product in instance.products:
-        product_saved(None, product)
-
-    push_data('exchanges/%s/' % instance.uuid,
-              serialize_exchange(instance))
+    enqueue_push(instance)
 
 
+@receiver
 def exchange_deleted(sender, instance, **kwargs):
-    delete_data('exchanges/%s/' % instance.uuid)
+    enqueue_delete(instance)
 
 
+@receiver
 def calendar_saved(sender, instance, **kwargs):
-    push_data('calendars/%s/' % instance.uuid, serialize_calendar(instance))
+    enqueue_push(instance)
 
 
+@receiver
 def calendar_deleted(sender, instance, **kwargs):
-    delete_data('calendars/%s/' % instance.uuid)
+    enqueue_delete(instance)
 
 
+@receiver
 def event_saved(sender, instance, **kwargs):
-    data = serialize_event(instance)
-
-    #Ensure calendar exists on the pes
-    calendar = Calendar.objects.get(uuid=data['calendar'])
-    calendar_saved(None, calendar)
-
-    #Ensure organizations exists on the pes
-    organization = Organization.objects.get(uuid=data['organization'])
-    organization_saved(None, organization)
-
-    for organization_uuid in data['organizations']:
-        organization = Organization.objects.get(uuid=organization_uuid)
-        organization_saved(None, organization)
-
-    push_data('events/%s/' % instance.uuid, data)
+    enqueue_push(instance)
 
 
+@receiver
 def event_deleted(sender, instance, **kwargs):
-    delete_data('events/%s/' % instance.uuid)
+    enqueue_delete(instance)
 
 
+@receiver
 def location_saved(sender, instance, **kwargs):
-    push_data('locations/%s/' % instance.uuid, serialize_location(instance))
+    enqueue_push(instance)
 
 
+@receiver
 def location_deleted(sender, instance, **kwargs):
-    delete_data('locations/%s/' % instance.uuid)
+    enqueue_delete(instance)
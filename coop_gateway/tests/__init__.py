@@ -0,0 +1,20 @@
+from coop_gateway.tests.test_client import SendTest
+from coop_gateway.tests.test_jsonstream import IterArrayTest
+from coop_gateway.tests.test_listing import (
+    DownloadedListingTest,
+    IterPagesTest,
+    NextQueriesTest,
+)
+from coop_gateway.tests.test_pes_import import ApplyChunkTest
+from coop_gateway.tests.test_reconcile import ReconcileTest
+
+
+__all__ = [
+    'ApplyChunkTest',
+    'DownloadedListingTest',
+    'IterArrayTest',
+    'IterPagesTest',
+    'NextQueriesTest',
+    'ReconcileTest',
+    'SendTest',
+]
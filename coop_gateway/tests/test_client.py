@@ -0,0 +1,96 @@
+import requests
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+from coop_gateway import client
+
+
+class Response(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Session(object):
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.requests = 0
+
+    def request(self, method, url, **kwargs):
+        self.requests += 1
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+class SendTest(SimpleTestCase):
+
+    def setUp(self):
+        self.overridden = override_settings(PES_RETRIES=3, PES_BACKOFF=0.5)
+        self.overridden.enable()
+        self.session = getattr(client._local, 'session', None)
+        self.time = client.time
+        self.clock = client.time = Clock()
+
+    def tearDown(self):
+        self.overridden.disable()
+        client._local.session = self.session
+        client.time = self.time
+
+    def send(self, *results):
+        session = client._local.session = Session(results)
+        response = client.send('GET', 'http://pes/api/persons/')
+        return response, session
+
+    def test_success(self):
+        response, session = self.send(Response(200))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(session.requests, 1)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_retries_server_errors(self):
+        failed = Response(503)
+        response, session = self.send(failed, Response(502), Response(200))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(failed.closed)
+        self.assertEqual(self.clock.sleeps, [0.5, 1.0])
+
+    def test_gives_up(self):
+        response, session = self.send(*[Response(503) for _ in range(4)])
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.closed)
+        self.assertEqual(session.requests, 4)
+        self.assertEqual(self.clock.sleeps, [0.5, 1.0, 2.0])
+
+    def test_client_errors_are_not_retried(self):
+        for status_code in (404, 501):
+            response, session = self.send(Response(status_code))
+            self.assertEqual(response.status_code, status_code)
+            self.assertEqual(session.requests, 1)
+
+    def test_retries_connection_errors(self):
+        response, session = self.send(requests.ConnectionError(),
+                                       requests.Timeout(),
+                                       Response(200))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.clock.sleeps, [0.5, 1.0])
+
+    def test_raises_connection_errors(self):
+        with self.assertRaises(requests.ConnectionError):
+            self.send(*[requests.ConnectionError() for _ in range(4)])
+        self.assertEqual(self.clock.sleeps, [0.5, 1.0, 2.0])
@@ -0,0 +1,61 @@
+# encoding: utf-8
+
+import json
+
+from django.test import SimpleTestCase
+
+from coop_gateway.jsonstream import (
+    JSONStreamError,
+    iter_array,
+)
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class IterArrayTest(SimpleTestCase):
+
+    def assertParsedByChunks(self, data):
+        expected = json.loads(data.decode('utf-8'))
+        for size in range(1, len(data) + 1):
+            self.assertEqual(list(iter_array(chunked(data, size))), expected)
+
+    def test_objects(self):
+        self.assertParsedByChunks(
+            b'[{"uuid": "a", "members": [1, 2]}, {"uuid": "b"}, []]')
+
+    def test_whitespace(self):
+        self.assertParsedByChunks(b' \n[ {"a" : 1} ,\n\t{"b": 2} ] \n')
+
+    def test_empty(self):
+        self.assertParsedByChunks(b'[]')
+        self.assertParsedByChunks(b'[ ]')
+
+    def test_numbers_and_literals(self):
+        self.assertParsedByChunks(
+            b'[12345, -6.5e3, true, false, null, "a,]", 0]')
+
+    def test_multibyte_characters(self):
+        self.assertParsedByChunks(
+            u'["été", {"ville": "Besançon", "日本": "語"}]'.encode('utf-8'))
+
+    def test_not_an_array(self):
+        with self.assertRaises(JSONStreamError):
+            list(iter_array([b'{"a": 1}']))
+
+    def test_truncated_object(self):
+        items = iter_array(chunked(b'[{"a": 1}, {"b"', 4))
+        self.assertEqual(next(items), {'a': 1})
+        with self.assertRaises(ValueError):
+            next(items)
+
+    def test_truncated_number(self):
+        items = iter_array([b'[1, 2'])
+        self.assertEqual(next(items), 1)
+        with self.assertRaises(JSONStreamError):
+            next(items)
+
+    def test_unclosed(self):
+        with self.assertRaises(JSONStreamError):
+            list(iter_array([b'[{"a": 1}', b' ']))
@@ -0,0 +1,133 @@
+from multiprocessing.pool import ThreadPool
+
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+from coop_gateway import listing
+from coop_gateway.listing import (
+    DownloadedListing,
+    iter_pages,
+    next_queries,
+)
+
+
+def page(count, results, next_url):
+    return {'count': count, 'results': results, 'next': next_url}
+
+
+class NextQueriesTest(SimpleTestCase):
+
+    def test_page_numbers(self):
+        first = page(25, [1] * 10,
+                     'http://pes/api/persons/?page=2&page_size=10')
+        self.assertEqual(next_queries(first), ('http://pes/api/persons/', [
+            {'page': 2, 'page_size': '10'},
+            {'page': 3, 'page_size': '10'},
+        ]))
+
+    def test_offsets(self):
+        first = page(25, [1] * 10,
+                     'http://pes/api/persons/?limit=10&offset=10'
+                     '&modified_since=yesterday')
+        self.assertEqual(next_queries(first), ('http://pes/api/persons/', [
+            {'limit': '10', 'offset': 10, 'modified_since': 'yesterday'},
+            {'limit': '10', 'offset': 20, 'modified_since': 'yesterday'},
+        ]))
+
+    def test_other_links(self):
+        first = page(25, [1] * 10, 'http://pes/api/persons/?cursor=abc')
+        self.assertIsNone(next_queries(first))
+
+    def test_without_count(self):
+        first = {'results': [1] * 10,
+                 'next': 'http://pes/api/persons/?page=2'}
+        self.assertIsNone(next_queries(first))
+
+    def test_last_page(self):
+        self.assertIsNone(next_queries(page(5, [1] * 5, None)))
+
+
+class IterPagesTest(SimpleTestCase):
+
+    def setUp(self):
+        self.fetch_page = listing.fetch_page
+        self.fetched = []
+
+    def tearDown(self):
+        listing.fetch_page = self.fetch_page
+
+    def serve(self, pages):
+        def fetch_page(url, params=None):
+            self.fetched.append((url, params))
+            return pages[url, tuple(sorted((params or {}).items()))]
+        listing.fetch_page = fetch_page
+
+    def test_numbered(self):
+        url = 'http://pes/api/persons/'
+        self.serve({
+            (url, (('limit', '2'), ('offset', 2))): page(5, [3, 4], None),
+            (url, (('limit', '2'), ('offset', 4))): page(5, [5], None),
+        })
+        first = page(5, [1, 2], url + '?limit=2&offset=2')
+
+        pages = list(iter_pages(first, 2))
+        self.assertEqual([p['results'] for p in pages], [[1, 2], [3, 4], [5]])
+
+    def test_linked(self):
+        self.serve({
+            ('http://pes/2', ()): page(5, [3, 4], 'http://pes/3'),
+            ('http://pes/3', ()): page(5, [5], None),
+        })
+        first = page(5, [1, 2], 'http://pes/2')
+
+        pages = list(iter_pages(first, 2))
+        self.assertEqual([p['results'] for p in pages], [[1, 2], [3, 4], [5]])
+        self.assertEqual(self.fetched, [('http://pes/2', None),
+                                        ('http://pes/3', None)])
+
+
+class Records(object):
+
+    def __init__(self, count, error=None):
+        self.count = count
+        self.error = error
+
+    def __iter__(self):
+        for number in range(self.count):
+            yield {'number': number}
+        if self.error is not None:
+            raise self.error
+
+
+class DownloadedListingTest(SimpleTestCase):
+
+    def setUp(self):
+        self.overridden = override_settings(PES_DOWNLOAD_RECORDS=3)
+        self.overridden.enable()
+        self.pool = ThreadPool(1)
+
+    def tearDown(self):
+        self.overridden.disable()
+        self.pool.terminate()
+
+    def test_order(self):
+        downloaded = DownloadedListing(Records(20))
+        downloaded.start(self.pool)
+        self.assertEqual([data['number'] for data in downloaded],
+                         list(range(20)))
+
+    def test_spooled(self):
+        downloaded = DownloadedListing(Records(20))
+        downloaded.download()
+        self.assertTrue(downloaded.written > 0)
+        self.assertEqual([data['number'] for data in downloaded],
+                         list(range(20)))
+
+    def test_error(self):
+        downloaded = DownloadedListing(Records(5, IOError('lost')))
+        downloaded.start(self.pool)
+        numbers = []
+        with self.assertRaises(IOError):
+            for data in downloaded:
+                numbers.append(data['number'])
+        self.assertEqual(numbers, list(range(5)))
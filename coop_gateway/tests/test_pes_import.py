@@ -0,0 +1,80 @@
+import sys
+
+from django.test import TestCase
+
+from coop_gateway.management.commands.pes_import import PesImport
+
+
+class Created(object):
+
+    def __init__(self, pk):
+        self.pk = pk
+
+
+class FailingImport(PesImport):
+    """Creates the records without saving them, failing the ones marked
+    bad."""
+    key = 'uuid'
+
+    class model(object):
+        pass
+
+    def __init__(self):
+        self.index = {}
+        self.applied = []
+
+    def _apply_one(self, data):
+        self.applied.append(data['uuid'])
+        if data.get('bad'):
+            raise ValueError(data['uuid'])
+        return Created(len(self.applied))
+
+
+class Discard(object):
+
+    def write(self, data):
+        pass
+
+
+class ApplyChunkTest(TestCase):
+
+    def setUp(self):
+        self.stderr, sys.stderr = sys.stderr, Discard()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+
+    def records(self, count, bad=()):
+        return [
+            {'uuid': str(number), 'bad': number in bad}
+            for number in range(count)
+        ]
+
+    def test_chunk(self):
+        handler = FailingImport()
+        self.assertEqual(handler._apply_chunk(self.records(4)), 0)
+        self.assertEqual(handler.applied, ['0', '1', '2', '3'])
+        self.assertEqual(sorted(handler.index), ['0', '1', '2', '3'])
+
+    def test_bisects_failing_records(self):
+        handler = FailingImport()
+        self.assertEqual(handler._apply_chunk(self.records(8, bad=(5,))), 1)
+        self.assertEqual(sorted(handler.index),
+                         ['0', '1', '2', '3', '4', '6', '7'])
+        # The chunk, then the halves, quarters and records of the failing
+        # part
+        self.assertEqual(handler.applied, [
+            '0', '1', '2', '3', '4', '5',
+            '0', '1', '2', '3',
+            '4', '5',
+            '4', '5',
+            '4',
+            '5',
+            '6', '7',
+        ])
+
+    def test_several_failing_records(self):
+        handler = FailingImport()
+        self.assertEqual(
+            handler._apply_chunk(self.records(8, bad=(0, 3, 7))), 3)
+        self.assertEqual(sorted(handler.index), ['1', '2', '4', '5', '6'])
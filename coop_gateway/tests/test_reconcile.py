@@ -0,0 +1,112 @@
+from django.test import SimpleTestCase
+
+from coop_gateway.reconcile import reconcile
+
+
+class QuerySet(object):
+
+    def __init__(self, log, filters):
+        self.log = log
+        self.filters = filters
+
+    def update(self, **fields):
+        self.log.append(('update', self.filters, fields))
+
+    def delete(self):
+        self.log.append(('delete', self.filters))
+
+
+class Manager(object):
+
+    def __init__(self, log):
+        self.log = log
+
+    def filter(self, **filters):
+        return QuerySet(self.log, filters)
+
+    def bulk_create(self, instances):
+        self.log.append(('bulk_create', [row.key for row in instances]))
+
+
+class Row(object):
+
+    def __init__(self, log, pk, key, value=None):
+        self.log = log
+        self.pk = pk
+        self.key = key
+        self.value = value
+
+    def save(self):
+        self.log.append(('save', self.key, self.value))
+
+
+class ReconcileTest(SimpleTestCase):
+
+    def setUp(self):
+        self.log = []
+
+        class Model(object):
+            objects = Manager(self.log)
+
+        self.model = Model
+
+    def row(self, pk, key, value=None):
+        return Row(self.log, pk, key, value)
+
+    def reconcile(self, existing, incoming, **kwargs):
+        def changes(row, data):
+            if row.value != data['value']:
+                return {'value': data['value']}
+            return {}
+
+        return reconcile(self.model,
+                         existing,
+                         incoming,
+                         lambda row: row.key,
+                         lambda data: data['key'],
+                         lambda data: self.row(None, data['key'],
+                                               data['value']),
+                         changes,
+                         **kwargs)
+
+    def test_unchanged(self):
+        result = self.reconcile([self.row(1, 'a', 1), self.row(2, 'b', 2)],
+                                [{'key': 'b', 'value': 2},
+                                 {'key': 'a', 'value': 1}])
+        self.assertEqual(result, (0, 0, 0))
+        self.assertEqual(self.log, [])
+
+    def test_saves_one_by_one(self):
+        result = self.reconcile([self.row(1, 'a', 1), self.row(2, 'b', 2)],
+                                [{'key': 'a', 'value': 10},
+                                 {'key': 'c', 'value': 3}])
+        self.assertEqual(result, (1, 1, 1))
+        self.assertEqual(self.log, [
+            ('save', 'a', 10),
+            ('delete', {'pk__in': [2]}),
+            ('save', 'c', 3),
+        ])
+
+    def test_bulk(self):
+        result = self.reconcile([self.row(1, 'a', 1), self.row(2, 'b', 2)],
+                                [{'key': 'a', 'value': 10},
+                                 {'key': 'c', 'value': 3},
+                                 {'key': 'd', 'value': 4}],
+                                bulk=True)
+        self.assertEqual(result, (2, 1, 1))
+        self.assertEqual(self.log, [
+            ('update', {'pk': 1}, {'value': 10}),
+            ('delete', {'pk__in': [2]}),
+            ('bulk_create', ['c', 'd']),
+        ])
+
+    def test_duplicates(self):
+        result = self.reconcile([self.row(1, 'a', 1), self.row(2, 'a', 1)],
+                                [{'key': 'a', 'value': 1},
+                                 {'key': 'b', 'value': 2},
+                                 {'key': 'b', 'value': 3}])
+        self.assertEqual(result, (1, 0, 1))
+        self.assertEqual(self.log, [
+            ('delete', {'pk__in': [2]}),
+            ('save', 'b', 2),
+        ])